@@ -0,0 +1,157 @@
+from datetime import datetime, timedelta
+from minio_util import client, BUCKET_NAME, MINIO_ENDPOINT, MINIO_USER, MINIO_PWD
+import pandas as pd
+import duckdb
+import os
+import re
+
+
+# Query the run archive in MinIO ({source}/{YYYY-MM-DD}/{HH}/...) with DuckDB, without
+# going through Postgres. Only the runs within the requested time range are listed,
+# and DuckDB reads only the requested columns of each file
+ARCHIVE_THREADS = int(os.getenv("ARCHIVE_QUERY_THREADS", os.cpu_count() or 4))
+
+# Run files of each kind, relative to the run prefix. Parquet output is one combined
+# file in older runs, numbered parts since transform writes it in chunks
+RUN_FILES = {
+    "parquet": r"combined\.parquet|combined/part-\d+\.parquet",
+    "csv": r"combined\.csv",
+    "json": r"shards/.+\.ndjson\.gz",
+}
+
+
+def quote(value: str):
+    # SQL string literal
+    return "'" + (value or "").replace("'", "''") + "'"
+
+
+def quote_identifier(name: str):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect(threads: int = ARCHIVE_THREADS):
+    conn = duckdb.connect()
+    conn.execute("INSTALL httpfs")
+    conn.execute("LOAD httpfs")
+    conn.execute(f"SET threads = {int(threads)}")
+
+    # MinIO serves buckets path-style over plain HTTP
+    conn.execute(
+        f"""
+        CREATE SECRET minio (
+            TYPE s3,
+            KEY_ID {quote(MINIO_USER)},
+            SECRET {quote(MINIO_PWD)},
+            ENDPOINT {quote(MINIO_ENDPOINT)},
+            URL_STYLE 'path',
+            USE_SSL false
+        )
+        """
+    )
+    return conn
+
+
+def list_prefixes(prefix: str):
+    # Sub-"directories" right under the prefix, without listing their contents
+    for obj in client.list_objects(bucket_name=BUCKET_NAME, prefix=prefix):
+        if obj.is_dir:
+            yield obj.object_name[len(prefix) :].rstrip("/")
+
+
+def list_runs(source: str = "cargurus", start: datetime = None, end: datetime = None):
+    # Time frames (YYYY-MM-DD/HH) of the runs from start up to, not including, end.
+    # Dates outside the range are skipped before their hours are listed
+    runs = []
+    for date in sorted(list_prefixes(f"{source}/")):
+        try:
+            day = datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if (start is not None and day + timedelta(days=1) <= start) or (
+            end is not None and day >= end
+        ):
+            continue
+        for hour in sorted(list_prefixes(f"{source}/{date}/")):
+            if not hour.isdigit():
+                continue
+            run_time = day + timedelta(hours=int(hour))
+            if (start is None or run_time >= start) and (end is None or run_time < end):
+                runs.append(f"{date}/{hour}")
+    return runs
+
+
+def object_url(object_name: str):
+    return f"s3://{BUCKET_NAME}/{object_name}"
+
+
+def run_files(source: str, runs: list, kind: str):
+    files = []
+    for run in runs:
+        prefix = f"{source}/{run}/"
+        for obj in client.list_objects(
+            bucket_name=BUCKET_NAME, prefix=prefix, recursive=True
+        ):
+            if re.fullmatch(RUN_FILES[kind], obj.object_name[len(prefix) :]):
+                files.append(object_url(obj.object_name))
+    return files
+
+
+def select_columns(columns: list, kind: str):
+    # Columns use the flattened names of the combined files, e.g. "specs.vin". The raw
+    # JSON records are nested, so there the name is a path into the record
+    if columns is None:
+        return "* EXCLUDE (filename)"
+    if kind == "json":
+        paths = [".".join(map(quote_identifier, name.split("."))) for name in columns]
+        return ", ".join(
+            f"{path} AS {quote_identifier(name)}" for path, name in zip(paths, columns)
+        )
+    return ", ".join(map(quote_identifier, columns))
+
+
+def read_function(files: list, kind: str):
+    file_list = "[" + ", ".join(map(quote, files)) + "]"
+    if kind == "parquet":
+        return f"read_parquet({file_list}, filename = true, union_by_name = true)"
+    if kind == "csv":
+        return f"read_csv({file_list}, filename = true, union_by_name = true)"
+    return (
+        f"read_json({file_list}, format = 'newline_delimited', "
+        "compression = 'gzip', filename = true, union_by_name = true)"
+    )
+
+
+def query_archive(
+    columns: list = None,
+    where: str = None,
+    start: datetime = None,
+    end: datetime = None,
+    source: str = "cargurus",
+    kind: str = "parquet",
+    conn: duckdb.DuckDBPyConnection = None,
+    params: dict = None,
+):
+    # Returns the selected columns of every run in [start, end) as one DataFrame, with
+    # each row's run_date and run_hour. where is a DuckDB SQL condition over the
+    # selected columns, run_date and run_hour, and is run as written: it must come
+    # from trusted code, never from user input. Values go in params and are referenced
+    # as $name, e.g. where='"specs.make" = $make', params={"make": "Ford"}
+    if kind not in RUN_FILES:
+        raise ValueError(f"Unknown run file kind: {kind}")
+    files = run_files(source, list_runs(source, start, end), kind)
+    if not files:
+        print(f"No {kind} run files between {start} and {end}")
+        return pd.DataFrame(columns=(columns or []) + ["run_date", "run_hour"])
+
+    conn = conn or connect()
+    sql = f"""
+        SELECT * FROM (
+            SELECT
+                {select_columns(columns, kind)},
+                regexp_extract(filename, '/(\\d{{4}}-\\d{{2}}-\\d{{2}})/\\d{{2}}/', 1)::DATE AS run_date,
+                regexp_extract(filename, '/\\d{{4}}-\\d{{2}}-\\d{{2}}/(\\d{{2}})/', 1)::INTEGER AS run_hour
+            FROM {read_function(files, kind)}
+        )
+        WHERE {where or "true"}
+    """
+    return conn.execute(sql, params).df()
@@ -0,0 +1,57 @@
+# Compares per-record decode time and memory of the typed decoder with the dict based
+# parse_details. Run from the repository root: python -m benchmarks.bench_decode
+from benchmarks.fixtures import detail_payload
+from main_extract import parse_details
+import details_decoder
+import tracemalloc
+import argparse
+import time
+import json
+
+
+def legacy_decode(content: bytes, id: str, zip: str):
+    return parse_details(json.loads(content), id, zip)
+
+
+def measure(decode, payloads: list, zip: str):
+    start = time.perf_counter()
+    for id, content in payloads:
+        decode(content, id, zip)
+    elapsed = time.perf_counter() - start
+
+    # Peak while decoding, and what the decoded records keep alive afterwards
+    tracemalloc.start()
+    records = [decode(content, id, zip) for id, content in payloads]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return elapsed, retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--padding", type=int, default=150)
+    args = parser.parse_args()
+
+    payloads = [
+        (str(id), json.dumps(detail_payload(id, args.padding)).encode("utf-8"))
+        for id in range(args.records)
+    ]
+    size = sum(len(content) for _, content in payloads) / len(payloads)
+    print(f"{args.records} records, {size / 1024:.1f} KiB per payload")
+
+    for name, decode in [
+        ("parse_details", legacy_decode),
+        ("decode_details", details_decoder.decode_details),
+    ]:
+        elapsed, retained, peak = measure(decode, payloads, "75081")
+        print(
+            f"{name:>15}: {elapsed / args.records * 1e6:8.1f} us/record, "
+            f"{retained / args.records:8.0f} B/record retained, "
+            f"{peak / 1024 / 1024:8.1f} MiB peak"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+# Offline end-to-end benchmark of extract, transform and load. CarGurus is replaced by a
+# stub server, MinIO by a directory-backed object store and Postgres by a throwaway
+# cluster (initdb/pg_ctl on PATH or in PG_BIN) or a scratch database on --postgres-host;
+# without either, load is skipped.
+# Run from the repository root: python -m benchmarks.bench_pipeline --scales 1000,10000
+from benchmarks.object_store import LocalObjectStore
+from benchmarks.stub_server import serve_stub, PAGE_SIZE
+from contextlib import redirect_stdout, nullcontext
+import pyarrow.parquet as pq
+import multiprocessing
+import subprocess
+import tempfile
+import argparse
+import resource
+import asyncio
+import socket
+import shutil
+import psycopg
+import json
+import time
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ZIP = "75081"
+DISTANCE = "50"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def run_command(command: list):
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{command[0]} failed: {result.stderr.strip()}")
+
+
+class BenchPostgres:
+    # An existing server; each scale gets a freshly created database on it
+    def __init__(
+        self, host: str, port: int, user: str = "postgres", password: str = ""
+    ):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def reset(self, dbname: str = "used_cars_bench"):
+        # Fresh database with the pipeline schema, returns the env main_load reads
+        params = {
+            "user": self.user,
+            "password": self.password,
+            "host": self.host,
+            "port": self.port,
+        }
+        with psycopg.connect(dbname="postgres", autocommit=True, **params) as conn:
+            conn.execute(f"DROP DATABASE IF EXISTS {dbname}")
+            conn.execute(f"CREATE DATABASE {dbname}")
+        with psycopg.connect(dbname=dbname, **params) as conn:
+            with open(os.path.join(REPO_ROOT, "db_init.sql")) as file:
+                conn.execute(file.read())
+        return {
+            "POSTGRES_HOST": self.host,
+            "POSTGRES_PORT": str(self.port),
+            "POSTGRES_DB": dbname,
+            "POSTGRES_USER": self.user,
+            "POSTGRES_PWD": self.password,
+        }
+
+
+class ThrowawayPostgres(BenchPostgres):
+    # A temporary cluster listening on a Unix socket only, removed afterwards
+    def __init__(self, bin_dir: str):
+        self.root = tempfile.mkdtemp(prefix="bench-pg-")
+        self.bin_dir = bin_dir
+        self.data_dir = os.path.join(self.root, "data")
+        super().__init__(host=self.root, port=free_port())
+
+    def __enter__(self):
+        run_command(
+            [self._bin("initdb"), "-D", self.data_dir, "-U", self.user, "-A", "trust"]
+        )
+        run_command(
+            [
+                self._bin("pg_ctl"),
+                "-D",
+                self.data_dir,
+                "-l",
+                os.path.join(self.root, "postgres.log"),
+                "-o",
+                f"-p {self.port} -k {self.root} -c listen_addresses=''",
+                "-w",
+                "start",
+            ]
+        )
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        subprocess.run(
+            [self._bin("pg_ctl"), "-D", self.data_dir, "-m", "immediate", "stop"],
+            capture_output=True,
+        )
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _bin(self, name: str):
+        return os.path.join(self.bin_dir, name)
+
+
+def find_postgres_bin():
+    bin_dir = os.getenv("PG_BIN")
+    if bin_dir:
+        return bin_dir
+    initdb = shutil.which("initdb")
+    return os.path.dirname(initdb) if initdb else None
+
+
+def stage_process(stage: str, env: dict, options: dict, results):
+    # Runs in a fresh process, so peak RSS covers this stage alone
+    os.environ.update(env)
+    output = (
+        nullcontext() if options["verbose"] else redirect_stdout(open(os.devnull, "w"))
+    )
+    with output:
+        import minio_util
+        import curl_util
+
+        minio_util.client = LocalObjectStore(options["object_root"])
+        curl_util.PROXY_ENDPOINTS = [None]
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.perf_counter()
+        try:
+            if stage == "extract":
+                import main_extract
+                import metrics_util
+
+                # As run_extract_sync, without the request budget and page cap
+                with metrics_util.stage("extract", region=f"{ZIP}-{DISTANCE}"):
+                    asyncio.run(
+                        main_extract.extract(
+                            ZIP,
+                            DISTANCE,
+                            options["time_frame"],
+                            concurrency=options["concurrency"],
+                            host_budget=None,
+                            max_pages=options["listings"] // PAGE_SIZE + 1,
+                        )
+                    )
+            elif stage == "transform":
+                import main_transform
+
+                main_transform.transform(time_frame=options["time_frame"])
+            elif stage == "load":
+                import main_load
+
+                main_load.load(time_frame=options["time_frame"])
+            error = None
+        except Exception as e:
+            error = repr(e)
+        elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(
+        {
+            "stage": stage,
+            "seconds": elapsed,
+            "peak_rss_mib": peak / 1024,
+            "baseline_rss_mib": baseline / 1024,
+            "error": error,
+        }
+    )
+
+
+def run_stage(stage: str, env: dict, options: dict):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=stage_process, args=(stage, env, options, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def count_records(store: LocalObjectStore, stage: str, time_frame: str):
+    prefix = f"cargurus/{time_frame}"
+    if stage == "extract":
+        return sum(
+            len(json.loads(store.get_object(None, obj.object_name).read()))
+            for obj in store.list_objects(None, prefix=f"{prefix}/index/")
+        )
+    # Rows written by transform (and so read by load), as listed in its manifest
+    manifest = store.get_object(None, f"{prefix}/manifests/transform.json").read()
+    return sum(
+        pq.ParquetFile(store._path(obj["key"])).metadata.num_rows
+        for obj in json.loads(manifest)["objects"]
+    )
+
+
+def run_scale(listings: int, args, postgres: BenchPostgres):
+    work_dir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    stub_port = free_port()
+    stub = multiprocessing.get_context("spawn").Process(
+        target=serve_stub, args=(listings, args.padding, stub_port), daemon=True
+    )
+    stub.start()
+    wait_for_port(stub_port)
+
+    options = {
+        "object_root": os.path.join(work_dir, "objects"),
+        "time_frame": time.strftime("%Y-%m-%d/%H"),
+        "listings": listings,
+        "concurrency": args.concurrency,
+        "verbose": args.verbose,
+    }
+    env = {
+        "CARGURUS_BASE_URL": f"http://127.0.0.1:{stub_port}",
+        "LISTING_CACHE_PATH": os.path.join(work_dir, "cache", "listings.db"),
+    }
+    if postgres is not None:
+        env.update(postgres.reset())
+
+    store = LocalObjectStore(options["object_root"])
+    rows = []
+    try:
+        for stage in ["extract", "transform", "load"]:
+            if stage == "load" and postgres is None:
+                print("Skipping load: no Postgres (set PG_BIN or --postgres-host)")
+                continue
+            result = run_stage(stage, env, options)
+            result["listings"] = listings
+            result["records"] = (
+                0
+                if result["error"]
+                else count_records(store, stage, options["time_frame"])
+            )
+            result["records_per_sec"] = result["records"] / result["seconds"]
+            rows.append(result)
+            print(
+                f"{listings:>8} {stage:>9}: {result['records']:>8} records "
+                f"{result['seconds']:8.2f}s {result['records_per_sec']:10.1f} rec/s "
+                f"{result['peak_rss_mib']:8.1f} MiB peak RSS"
+                + (f"  FAILED {result['error']}" if result["error"] else "")
+            )
+            if result["error"]:
+                break
+    finally:
+        stub.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", default="1000,10000")
+    parser.add_argument("--padding", type=int, default=150)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true")
+    # Use an existing server instead of a throwaway cluster
+    parser.add_argument("--postgres-host")
+    parser.add_argument("--postgres-port", type=int, default=5432)
+    parser.add_argument("--postgres-user", default="postgres")
+    parser.add_argument("--postgres-password", default="")
+    args = parser.parse_args()
+
+    bin_dir = find_postgres_bin()
+    if args.postgres_host:
+        postgres = BenchPostgres(
+            args.postgres_host,
+            args.postgres_port,
+            args.postgres_user,
+            args.postgres_password,
+        )
+    elif bin_dir:
+        postgres = ThrowawayPostgres(bin_dir)
+    else:
+        postgres = None
+    rows = []
+    with postgres if postgres is not None else nullcontext():
+        for listings in [int(scale) for scale in args.scales.split(",")]:
+            rows.extend(run_scale(listings, args, postgres))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(rows, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
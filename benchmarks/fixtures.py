@@ -0,0 +1,104 @@
+import random
+
+ENGINES = [
+    "2.0L I4 Turbo",
+    "3.5L V6",
+    "5.0L V8 400hp 410ft. lbs.",
+    "306 hp 3.5L V6",
+    "Electric",
+    None,
+    "1.5L I3 Turbo 181hp 177ft. lbs.",
+]
+TRANSMISSIONS = [
+    "8-Speed Automatic",
+    "Automatic",
+    "Continuously Variable Transmission (CVT)",
+    "6-Speed Manual",
+    None,
+    "10-Speed Automatic",
+]
+MAKES = {
+    "Ford": ["F-150", "Escape", "Mustang"],
+    "Toyota": ["Camry", "RAV4", "Tacoma"],
+    "Honda": ["Civic", "Accord", "CR-V"],
+    "Chevrolet": ["Silverado 1500", "Equinox", "Malibu"],
+}
+OPTIONS = [
+    "Tow Package",
+    "Sunroof",
+    "Leather Seats",
+    "Navigation System",
+    "Backup Camera",
+    "Bluetooth",
+    "Heated Seats",
+    "Alloy Wheels",
+]
+
+
+def detail_payload(id: int, padding: int = 150):
+    # Synthetic detail response, seeded by id. `padding` adds fields the extractor
+    # ignores, as the real payload carries far more than the fields we read
+    r = random.Random(id)
+    make = r.choice(list(MAKES))
+    vehicle_history = {
+        "accidentCount": r.randint(0, 2),
+        "ownerCount": r.randint(1, 3),
+        "hasVehicleHistoryReport": True,
+    }
+    if r.random() < 0.5:
+        vehicle_history["isFleet"] = r.random() < 0.2
+    listing = {
+        "id": id,
+        "price": float(r.randint(5000, 60000)),
+        "expectedPrice": float(r.randint(5000, 60000)),
+        "dealRatingKey": r.choice(["GREAT_PRICE", "GOOD_PRICE", "FAIR_PRICE"]),
+        "savedCount": r.randint(0, 50),
+        "vin": f"1FTFW1E5{id:09d}",
+        "listingTitleOnly": f"{r.randint(2005, 2026)} {make}",
+        "makeName": make,
+        "modelName": r.choice(MAKES[make]),
+        "year": r.randint(2005, 2026),
+        "trimName": r.choice(["Base", "XLT", "LE", "EX", "LT"]),
+        "mileage": r.randint(0, 200000),
+        "vehicleCondition": "USED",
+        "localizedExteriorColor": r.choice(["Red", "White", "Black", "Silver"]),
+        "localizedInteriorColor": r.choice(["Black", "Gray", "Beige"]),
+        "localizedEngineDisplayName": r.choice(ENGINES),
+        "localizedDriveTrain": r.choice(["FWD", "AWD", "4WD", "RWD"]),
+        "localizedTransmission": r.choice(TRANSMISSIONS),
+        "localizedFuelType": "Gasoline",
+        "options": r.sample(OPTIONS, r.randint(0, 6)),
+        "listingHistory": {
+            "daysAtDealer": r.randint(1, 90),
+            "daysOnCarGurus": r.randint(1, 90),
+        },
+        "vehicleHistory": vehicle_history,
+    }
+    for field, chance, low, high in [
+        ("cityFuelEconomy", 0.7, 15, 30),
+        ("highwayFuelEconomy", 0.7, 20, 40),
+        ("combinedFuelEconomy", 0.3, 18, 33),
+    ]:
+        if r.random() < chance:
+            listing[field] = {"value": float(r.randint(low, high)), "unit": "MPG"}
+    for n in range(padding):
+        listing[f"extra{n}"] = {"label": f"Field {n}", "values": [n, n * 2, n * 3]}
+
+    return {
+        "listing": listing,
+        "seller": {
+            "listingSellerId": r.randint(1, 300),
+            "sellerType": "DEALER",
+            "name": f"Dealer {r.randint(1, 300)}",
+            "address": {
+                "street": "1 Main St",
+                "cityRegion": "Dallas, TX",
+                "postalCode": "75081",
+            },
+            "phoneNumber": "(555) 555-0100",
+            "isFranchiseDealer": r.random() < 0.5,
+            "averageRating": round(r.random() * 5, 2),
+            "reviewCount": r.randint(0, 500),
+        },
+        "autoEntityInfo": {"bodyStyle": r.choice(["Sedan", "SUV", "Pickup Truck"])},
+    }
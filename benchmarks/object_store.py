@@ -0,0 +1,122 @@
+from minio import S3Error
+from datetime import datetime, timezone
+import threading
+import shutil
+import os
+
+
+class StoredObject:
+    def __init__(
+        self,
+        object_name: str,
+        size: int,
+        last_modified: datetime,
+        is_dir: bool = False,
+    ):
+        self.object_name = object_name
+        self.size = size
+        self.last_modified = last_modified
+        self.is_dir = is_dir
+
+
+class ObjectResponse:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class LocalObjectStore:
+    # Stand-in for the minio.Minio calls made by minio_util, backed by a local directory
+    # so separate stage processes see the same objects. Bucket names are ignored
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, object_name: str):
+        return os.path.join(self.root, *object_name.split("/"))
+
+    def _missing(self, object_name: str):
+        return S3Error(
+            "NoSuchKey",
+            "The specified key does not exist.",
+            object_name,
+            None,
+            None,
+            None,
+        )
+
+    def put_object(
+        self, bucket_name, object_name, data, length, content_type=None, **kwargs
+    ):
+        path = self._path(object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial object
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data.read(length) if length >= 0 else data.read())
+        os.replace(temp_path, path)
+
+    def fput_object(
+        self, bucket_name, object_name, file_path, content_type=None, **kwargs
+    ):
+        path = self._path(object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(file_path, path)
+
+    def remove_object(self, bucket_name, object_name, **kwargs):
+        try:
+            os.remove(self._path(object_name))
+        except FileNotFoundError:
+            pass
+
+    def get_object(self, bucket_name, object_name, offset=0, length=0, **kwargs):
+        try:
+            with open(self._path(object_name), "rb") as file:
+                file.seek(offset)
+                return ObjectResponse(file.read(length) if length else file.read())
+        except FileNotFoundError:
+            raise self._missing(object_name)
+
+    def stat_object(self, bucket_name, object_name, **kwargs):
+        path = self._path(object_name)
+        if not os.path.exists(path):
+            raise self._missing(object_name)
+        return self._object(object_name, path)
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False, **kwargs):
+        prefix = prefix or ""
+        names = []
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                if not file.endswith(".tmp"):
+                    path = os.path.join(directory, file)
+                    names.append(os.path.relpath(path, self.root).replace(os.sep, "/"))
+        # Like MinIO, a non-recursive listing returns each "directory" under the prefix once
+        directories = set()
+        for object_name in sorted(names):
+            if not object_name.startswith(prefix):
+                continue
+            if not recursive and "/" in object_name[len(prefix) :]:
+                directory = prefix + object_name[len(prefix) :].split("/")[0] + "/"
+                if directory not in directories:
+                    directories.add(directory)
+                    yield StoredObject(directory, 0, None, is_dir=True)
+                continue
+            yield self._object(object_name, self._path(object_name))
+
+    def _object(self, object_name: str, path: str):
+        stat = os.stat(path)
+        return StoredObject(
+            object_name,
+            stat.st_size,
+            datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+        )
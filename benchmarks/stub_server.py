@@ -0,0 +1,83 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from benchmarks.fixtures import detail_payload
+from functools import lru_cache
+import argparse
+import json
+import zlib
+
+PAGE_SIZE = 25
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Serves synthetic searchPage.action and detailListingJson.action responses. Each
+    # region (zip) gets its own `listings` ids
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, don't let them wait on delayed ACKs
+    disable_nagle_algorithm = True
+    listings = 1000
+    padding = 150
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/Cars/searchPage.action":
+            body = self.search_page(query["zip"][0], int(query["pageNumber"][0]))
+        elif url.path == "/Cars/detailListingJson.action":
+            body = detail_body(int(query["inventoryListing"][0]), self.padding)
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def search_page(self, zip: str, page: int):
+        region_offset = (zlib.crc32(zip.encode("utf-8")) % 100) * 1_000_000
+        first = (page - 1) * PAGE_SIZE
+        ids = range(first, min(first + PAGE_SIZE, self.listings))
+        tiles = [
+            {
+                "type": "LISTING",
+                "data": {
+                    "id": region_offset + id,
+                    "price": 10000 + id % 50000,
+                    "mileage": id * 7 % 200000,
+                },
+            }
+            for id in ids
+        ]
+        # Search pages mix in merchandising tiles the extractor skips
+        if tiles:
+            tiles.insert(1, {"type": "MERCH_CAROUSEL", "data": {"id": 0}})
+        return json.dumps({"tiles": tiles}).encode("utf-8")
+
+
+@lru_cache(maxsize=4096)
+def detail_body(id: int, padding: int):
+    return json.dumps(detail_payload(id, padding)).encode("utf-8")
+
+
+def serve_stub(listings: int, padding: int = 150, port: int = 8000):
+    handler = type(
+        "Handler", (StubHandler,), {"listings": listings, "padding": padding}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    # Standalone: CARGURUS_BASE_URL=http://127.0.0.1:8000 python main_extract.py
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listings", type=int, default=1000)
+    parser.add_argument("--padding", type=int, default=150)
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    serve_stub(args.listings, args.padding, args.port)
@@ -1,6 +1,13 @@
 from curl_cffi import requests
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from collections import deque
 from dotenv import load_dotenv
+import metrics_util
+import threading
+import asyncio
 import random
+import time
 import os
 
 load_dotenv(override=True)
@@ -8,17 +15,29 @@ proxies = {
     "http": os.getenv("STICKY_SMARTPROXY"),
     "https": os.getenv("STICKY_SMARTPROXY"),
 }
+# Comma separated proxy endpoints for the session pool, defaulting to the sticky proxy
+PROXY_ENDPOINTS = [
+    endpoint.strip()
+    for endpoint in os.getenv("SMARTPROXY_ENDPOINTS", "").split(",")
+    if endpoint.strip()
+] or [os.getenv("STICKY_SMARTPROXY")]
+IMPERSONATE_PROFILES = ["chrome", "edge", "safari", "firefox"]
+SESSION_POOL_SIZE = int(os.getenv("SESSION_POOL_SIZE", 4))
+
+# One session per thread and proxy setting, so repeated requests reuse the connection
+_local_sessions = threading.local()
 
 
 def send_curl_request(url, useProxy=False):
-    browser = random.choice(["chrome", "edge", "safari", "firefox"])
-    resp = requests.get(
-        url,
-        impersonate=browser,
-        proxies=proxies if useProxy else None,
-        verify=False,
-    )
-    return resp
+    if not hasattr(_local_sessions, "sessions"):
+        _local_sessions.sessions = {}
+    if useProxy not in _local_sessions.sessions:
+        _local_sessions.sessions[useProxy] = requests.Session(
+            impersonate=random.choice(IMPERSONATE_PROFILES),
+            proxies=proxies if useProxy else None,
+            verify=False,
+        )
+    return _local_sessions.sessions[useProxy].get(url)
 
 
 def get_curl_session():
@@ -29,3 +48,326 @@ def get_curl_session():
         verify=False,
     )
     return session
+
+
+REQUEST_SECONDS = metrics_util.histogram(
+    "http_request_seconds", "Request latency by endpoint"
+)
+REQUESTS = metrics_util.counter(
+    "http_requests_total", "Requests by endpoint and status (error for exceptions)"
+)
+FAILURES = metrics_util.counter(
+    "http_failures_total", "Throttled (429/403) and failed (5xx, exceptions) requests"
+)
+CIRCUIT_TRIPS = metrics_util.counter(
+    "http_circuit_trips_total", "Circuit breaker trips"
+)
+CONCURRENCY_LIMIT = metrics_util.gauge(
+    "http_concurrency_limit", "Current adaptive concurrency limit per host"
+)
+
+# Anti-bot throttling shows up as 429, or as 403 once the proxy session is flagged
+THROTTLE_STATUSES = {403, 429}
+RETRY_STATUSES = THROTTLE_STATUSES | {500, 502, 503, 504}
+
+
+def backoff_delay(attempt: int, base: float = 1, cap: float = 60):
+    # Full jitter: a random wait up to the exponential backoff, so retries don't line up
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class RequestBudgetExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class RequestResult:
+    def __init__(self):
+        self.status = None
+
+
+class HostState:
+    def __init__(self, limit: float, window: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.sent = 0
+        # Requests turned away once the budget ran out
+        self.refused = 0
+        self.ready = asyncio.Condition()
+        self.outcomes = deque(maxlen=window)
+        self.latency = None
+        self.best_latency = None
+        self.last_decrease = 0
+        self.failures = 0
+        self.paused_until = 0
+        self.probing = False
+        self.consecutive_trips = 0
+        self.trips = 0
+        self.tripped_at = 0
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        max_concurrency: int,
+        budget: int = None,
+        min_concurrency: int = 1,
+        initial_concurrency: int = None,
+        decrease: float = 0.5,
+        latency_factor: float = 2,
+        window: int = 20,
+        failure_threshold: float = 0.5,
+        cooldown: float = 30,
+        max_cooldown: float = 300,
+        max_trips: int = 5,
+        backoff: float = 1,
+    ):
+        # Per host AIMD concurrency: +1 per window of successful requests, multiplied by
+        # `decrease` on throttles/errors (at most once per round trip). Growth holds while
+        # latency is over `latency_factor` times the best seen.
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = initial_concurrency or max(
+            min_concurrency, max_concurrency // 2
+        )
+        self.budget = budget
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.window = window
+        # The circuit opens when `failure_threshold` of the last `window` requests failed,
+        # then lets a single probe through after the cooldown. Past `max_trips` it gives up
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_trips = max_trips
+        self.backoff = backoff
+        self.hosts = {}
+
+    @asynccontextmanager
+    async def acquire(self, url: str):
+        # Caller sets `status` on the yielded result; exceptions count as errors
+        host = urlsplit(url).hostname
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.initial_concurrency, self.window)
+        state = self.hosts[host]
+
+        if self.budget is not None and state.sent >= self.budget:
+            state.refused += 1
+            raise RequestBudgetExceeded(
+                f"Request budget of {self.budget} exhausted for {host}"
+            )
+        state.sent += 1
+
+        while True:
+            if state.trips > self.max_trips:
+                raise CircuitOpen(f"Circuit for {host} tripped {state.trips} times")
+            wait = state.paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            async with state.ready:
+                if state.in_flight < int(state.limit):
+                    state.in_flight += 1
+                    break
+                await state.ready.wait()
+
+        result = RequestResult()
+        outcome = None
+        start = time.monotonic()
+        try:
+            yield result
+            if result.status in THROTTLE_STATUSES:
+                outcome = "throttled"
+            elif result.status in RETRY_STATUSES:
+                outcome = "error"
+            else:
+                outcome = "ok"
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            async with state.ready:
+                state.in_flight -= 1
+                if outcome is not None:
+                    self._record(host, state, outcome, start)
+                    CONCURRENCY_LIMIT.set(state.limit, host=host)
+                state.ready.notify_all()
+
+    def _record(self, host: str, state: HostState, outcome: str, start: float):
+        now = time.monotonic()
+        latency = now - start
+        # Requests sent before the circuit opened say nothing about the probe
+        if start < state.tripped_at:
+            return
+        state.outcomes.append(outcome == "ok")
+        if outcome != "ok":
+            FAILURES.inc(host=host, outcome=outcome)
+
+        if outcome == "ok":
+            state.latency = (
+                latency
+                if state.latency is None
+                else 0.8 * state.latency + 0.2 * latency
+            )
+            state.best_latency = min(state.best_latency or state.latency, state.latency)
+            state.failures = 0
+            if state.probing:
+                print(f"Circuit for {host} closed")
+                state.probing = False
+                state.consecutive_trips = 0
+            if state.latency <= self.latency_factor * state.best_latency:
+                state.limit = min(self.max_concurrency, state.limit + 1 / state.limit)
+            return
+
+        # Back off every request to the host, longer for each failure in a row
+        state.failures += 1
+        state.paused_until = max(
+            state.paused_until, now + backoff_delay(state.failures - 1, self.backoff)
+        )
+        if now - state.last_decrease > (state.latency or 0):
+            state.limit = max(self.min_concurrency, state.limit * self.decrease)
+            state.last_decrease = now
+
+        failed = state.outcomes.count(False)
+        if state.probing or (
+            len(state.outcomes) == self.window
+            and failed >= self.failure_threshold * self.window
+        ):
+            self._trip(host, state, now)
+
+    def _trip(self, host: str, state: HostState, now: float):
+        CIRCUIT_TRIPS.inc(host=host)
+        state.trips += 1
+        state.consecutive_trips += 1
+        state.tripped_at = now
+        cooldown = min(
+            self.max_cooldown, self.cooldown * 2 ** (state.consecutive_trips - 1)
+        )
+        state.paused_until = now + cooldown
+        state.limit = self.min_concurrency
+        state.probing = True
+        state.outcomes.clear()
+        print(f"Circuit for {host} opened for {cooldown:.0f}s")
+
+    def summary(self):
+        for host, state in self.hosts.items():
+            print(
+                f"{host}: {state.sent} requests, concurrency {state.limit:.1f}, "
+                f"circuit tripped {state.trips} times"
+            )
+            if state.refused:
+                print(
+                    f"{host}: request budget of {self.budget} exhausted, "
+                    f"{state.refused} requests not sent"
+                )
+
+
+class PooledSession:
+    def __init__(self, proxy: str, browser: str, max_clients: int):
+        self.proxy = proxy
+        self.browser = browser
+        self.session = requests.AsyncSession(
+            impersonate=browser,
+            proxies={"http": proxy, "https": proxy} if proxy else None,
+            verify=False,
+            max_clients=max_clients,
+        )
+        self.in_flight = 0
+        self.requests = 0
+        # Moving average of request success, 1 is fully healthy
+        self.score = 1.0
+        self.retired = False
+
+    def record(self, ok: bool):
+        self.requests += 1
+        self.score = 0.9 * self.score + 0.1 * ok
+
+
+class SessionPool:
+    def __init__(
+        self,
+        size: int = SESSION_POOL_SIZE,
+        proxy_endpoints: list = None,
+        profiles: list = None,
+        max_clients: int = 10,
+        strategy: str = "least_loaded",
+        min_score: float = 0.5,
+        min_requests: int = 10,
+    ):
+        # Warm sessions spread over the proxies and browser profiles. Each session keeps
+        # its connections alive (HTTP/2 where the profile negotiates it), so requests skip
+        # the handshake. Sessions scoring under `min_score` after `min_requests` are
+        # replaced with a fresh session on the next proxy
+        self.proxy_endpoints = proxy_endpoints or PROXY_ENDPOINTS
+        self.profiles = profiles or IMPERSONATE_PROFILES
+        self.max_clients = -(-max_clients // size)
+        self.strategy = strategy
+        self.min_score = min_score
+        self.min_requests = min_requests
+        self.next_proxy = 0
+        self.next_session = 0
+        self.evicted = 0
+        self.sessions = [self._new_session() for _ in range(size)]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _new_session(self):
+        proxy = self.proxy_endpoints[self.next_proxy % len(self.proxy_endpoints)]
+        self.next_proxy += 1
+        return PooledSession(proxy, random.choice(self.profiles), self.max_clients)
+
+    def _checkout(self):
+        if self.strategy == "round_robin":
+            pooled = self.sessions[self.next_session % len(self.sessions)]
+            self.next_session += 1
+            return pooled
+        # Least loaded first, healthier first among equally loaded sessions
+        return min(self.sessions, key=lambda pooled: (pooled.in_flight, -pooled.score))
+
+    def _evict(self, pooled: PooledSession):
+        print(
+            f"Evicting {pooled.browser} session on proxy #{self.proxy_endpoints.index(pooled.proxy)} "
+            f"(score {pooled.score:.2f} after {pooled.requests} requests)"
+        )
+        pooled.retired = True
+        self.sessions[self.sessions.index(pooled)] = self._new_session()
+        self.evicted += 1
+
+    async def get(self, url: str, **kwargs):
+        pooled = self._checkout()
+        pooled.in_flight += 1
+        endpoint = urlsplit(url).path.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            response = await pooled.session.get(url, **kwargs)
+            pooled.record(response.status_code not in RETRY_STATUSES)
+            REQUESTS.inc(endpoint=endpoint, status=str(response.status_code))
+            return response
+        except Exception:
+            pooled.record(False)
+            REQUESTS.inc(endpoint=endpoint, status="error")
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+            pooled.in_flight -= 1
+            if (
+                not pooled.retired
+                and pooled.requests >= self.min_requests
+                and pooled.score < self.min_score
+            ):
+                self._evict(pooled)
+            # Retired sessions close once their last request is done
+            if pooled.retired and pooled.in_flight == 0:
+                await pooled.session.close()
+
+    async def close(self):
+        for pooled in self.sessions:
+            await pooled.session.close()
+        print(f"Session pool: {len(self.sessions)} sessions, {self.evicted} evicted")
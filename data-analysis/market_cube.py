@@ -0,0 +1,241 @@
+import os
+import time
+import threading
+import pandas as pd
+from functools import wraps
+from collections import OrderedDict
+from sqlalchemy import create_engine, text
+from db_connect import get_connection_url
+
+
+# Queries read the agg_market_cube summary table maintained by main_load.py, results
+# are kept in memory so repeated notebook/BI refreshes skip the database
+CACHE_SIZE = int(os.getenv("MARKET_CUBE_CACHE_SIZE", 256))
+CACHE_TTL = int(os.getenv("MARKET_CUBE_CACHE_TTL", 5 * 60))
+
+# Labels of the cube's price_bucket and mileage_band values, in order
+PRICE_BUCKETS = [
+    "<= 5,000",
+    "5,001 - 10,000",
+    "10,001 - 15,000",
+    "15,001 - 20,000",
+    "20,001 - 25,000",
+    "25,001 - 30,000",
+    "30,001 - 35,000",
+    "35,001 - 40,000",
+    "40,001 - 45,000",
+    "45,001 - 50,000",
+    "50,001 - 55,000",
+    "55,001 - 60,000",
+    "60,000+",
+]
+MILEAGE_BANDS = [
+    "< 30k (Very Low)",
+    "30k - 50k (Low)",
+    "50k - 70k (Medium)",
+    "70k - 90k (Medium High)",
+    "90k - 110k (High)",
+    "110k+ (Very High)",
+]
+GROUP_COLUMNS = [
+    "make",
+    "model",
+    "year_release",
+    "mileage_band",
+    "owner_count",
+    "accident_count",
+    "price_bucket",
+]
+
+
+class ResultCache:
+    # LRU of query results, entries expire after ttl seconds
+    def __init__(self, size: int = CACHE_SIZE, ttl: int = CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = ResultCache()
+_engine = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = create_engine(get_connection_url(), pool_pre_ping=True)
+    return _engine
+
+
+def cached(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # repr, so list arguments (e.g. group_by) work as keys too
+        key = (func.__name__, repr(args), repr(sorted(kwargs.items())))
+        result = cache.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            cache.put(key, result)
+        # Callers may modify the frame they get, the cached one stays as it was
+        return result.copy()
+
+    return wrapper
+
+
+def run_query(sql: str, params: dict):
+    with get_engine().connect() as conn:
+        return pd.read_sql(text(sql), conn, params=params)
+
+
+def cube_filter(
+    make: str = None, model: str = None, year_from: int = None, year_to: int = None
+):
+    conditions = []
+    params = {}
+    for column, op, value in [
+        ("make", "=", make),
+        ("model", "=", model),
+        ("year_release", ">=", year_from),
+        ("year_release", "<=", year_to),
+    ]:
+        if value is not None:
+            name = f"p{len(params)}"
+            conditions.append(f"{column} {op} :{name}")
+            params[name] = value
+    return " AND ".join(conditions) or "true", params
+
+
+@cached
+def price_distribution(make: str, model: str = None):
+    where, params = cube_filter(make, model)
+    df = run_query(
+        f"""
+        SELECT price_bucket, SUM(listing_count) AS unit_count
+        FROM agg_market_cube
+        WHERE {where}
+        GROUP BY price_bucket
+        ORDER BY price_bucket
+        """,
+        params,
+    )
+    df["price_category"] = pd.Categorical(
+        df["price_bucket"].map(PRICE_BUCKETS.__getitem__),
+        categories=PRICE_BUCKETS,
+        ordered=True,
+    )
+    return df[["price_category", "unit_count"]]
+
+
+@cached
+def avg_price_by_year(make: str, model: str = None):
+    where, params = cube_filter(make, model)
+    df = run_query(
+        f"""
+        SELECT year_release, ROUND(SUM(price_sum) / SUM(listing_count)) AS avg_price
+        FROM agg_market_cube
+        WHERE {where}
+        GROUP BY year_release
+        ORDER BY year_release DESC
+        """,
+        params,
+    )
+    # Rows run newest first, so the following year is the previous row
+    df["following_year_price_diff"] = df["avg_price"] - df["avg_price"].shift(1)
+    return df
+
+
+@cached
+def avg_price_by_mileage(make: str, model: str = None):
+    where, params = cube_filter(make, model)
+    df = run_query(
+        f"""
+        SELECT mileage_band, ROUND(SUM(price_sum) / SUM(listing_count)) AS avg_price
+        FROM agg_market_cube
+        WHERE {where}
+        GROUP BY mileage_band
+        ORDER BY mileage_band
+        """,
+        params,
+    )
+    df["mileage_category"] = df["mileage_band"].map(
+        lambda band: MILEAGE_BANDS[band - 1]
+    )
+    df["price_diff"] = df["avg_price"] - df["avg_price"].shift(1)
+    return df[["mileage_category", "avg_price", "price_diff"]]
+
+
+@cached
+def median_price_by(attribute: str, make: str, model: str = None):
+    # attribute: owner_count or accident_count, cars without a value are left out
+    if attribute not in ("owner_count", "accident_count"):
+        raise ValueError(f"Unsupported attribute: {attribute}")
+    where, params = cube_filter(make, model)
+    return run_query(
+        f"""
+        SELECT {attribute}, PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY p.price) AS median_price
+        FROM agg_market_cube CROSS JOIN LATERAL unnest(prices) AS p(price)
+        WHERE {where} AND {attribute} IS NOT NULL
+        GROUP BY {attribute}
+        ORDER BY {attribute}
+        """,
+        params,
+    )
+
+
+@cached
+def market_summary(
+    group_by: tuple = ("make",),
+    make: str = None,
+    model: str = None,
+    year_from: int = None,
+    year_to: int = None,
+):
+    # Listing count, price and mileage stats per group of any cube columns
+    unknown = set(group_by) - set(GROUP_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unsupported group_by columns: {sorted(unknown)}")
+    columns = ", ".join(group_by)
+    where, params = cube_filter(make, model, year_from, year_to)
+    return run_query(
+        f"""
+        SELECT
+            {columns},
+            SUM(listing_count) AS quantity,
+            ROUND(SUM(price_sum) / SUM(listing_count)) AS avg_price,
+            MIN(price_min) AS min_price,
+            MAX(price_max) AS max_price,
+            ROUND(SUM(mileage_sum)::float / SUM(listing_count)) AS avg_mileage,
+            SUM(save_count_sum) AS saves,
+            ROUND(SUM(days_on_cargurus_sum)::float / NULLIF(SUM(days_on_cargurus_count), 0)) AS avg_dom
+        FROM agg_market_cube
+        WHERE {where}
+        GROUP BY {columns}
+        ORDER BY quantity DESC
+        """,
+        params,
+    )
@@ -22,6 +22,17 @@ CREATE TABLE IF NOT EXISTS dim_car (
     options TEXT[]
 );
 
+-- Engine and transmission specs parsed from the display names during transform
+ALTER TABLE dim_car
+    ADD COLUMN IF NOT EXISTS engine_displacement REAL,
+    ADD COLUMN IF NOT EXISTS engine_configuration TEXT,
+    ADD COLUMN IF NOT EXISTS engine_cylinders INTEGER,
+    ADD COLUMN IF NOT EXISTS engine_horsepower INTEGER,
+    ADD COLUMN IF NOT EXISTS engine_torque INTEGER,
+    ADD COLUMN IF NOT EXISTS engine_aspiration TEXT,
+    ADD COLUMN IF NOT EXISTS transmission_type TEXT,
+    ADD COLUMN IF NOT EXISTS transmission_speeds INTEGER;
+
 CREATE TABLE IF NOT EXISTS dim_history (
     vin TEXT PRIMARY KEY,
     FOREIGN KEY (vin) REFERENCES dim_car(vin) ON DELETE CASCADE,
@@ -47,20 +58,307 @@ CREATE TABLE IF NOT EXISTS dim_seller (
     review_count INTEGER
 );
 
+-- Hash of each dimension row, so loads can skip rows that have not changed
+ALTER TABLE dim_car ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE dim_history ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE dim_seller ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+
+-- fact_latest_listing used to be a view over fact_listing, which is replaced by the
+-- table created below. Drop it before fact_listing is migrated, as the view would
+-- otherwise keep the old table from being dropped. fact_latest_listing_per_date is
+-- built on top of it and is recreated below
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('fact_listing') AND relkind = 'r')
+        OR EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('fact_latest_listing') AND relkind IN ('v', 'm')) THEN
+        DROP VIEW IF EXISTS fact_latest_listing_per_date;
+    END IF;
+    IF EXISTS (SELECT 1 FROM pg_views WHERE viewname = 'fact_latest_listing') THEN
+        DROP VIEW fact_latest_listing;
+    ELSIF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = 'fact_latest_listing') THEN
+        DROP MATERIALIZED VIEW fact_latest_listing;
+    END IF;
+END $$;
+
+-- Move an existing unpartitioned fact_listing aside, its rows are copied into the
+-- partitioned table below. created_at is the partition key and part of the primary
+-- key, so rows without it can't be moved: stop rather than drop them
+DO $$
+DECLARE
+    missing BIGINT;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('fact_listing') AND relkind = 'r') THEN
+        SELECT count(*) INTO missing FROM fact_listing WHERE created_at IS NULL;
+        IF missing > 0 THEN
+            RAISE EXCEPTION 'fact_listing has % rows without created_at, they cannot be partitioned', missing
+                USING HINT = 'Set created_at on those rows (or delete them), then run db_init.sql again.';
+        END IF;
+        ALTER TABLE fact_listing RENAME TO fact_listing_unpartitioned;
+        ALTER TABLE fact_listing_unpartitioned RENAME CONSTRAINT fact_listing_pkey TO fact_listing_unpartitioned_pkey;
+        ALTER SEQUENCE IF EXISTS fact_listing_id_seq RENAME TO fact_listing_unpartitioned_id_seq;
+        ALTER INDEX IF EXISTS fact_listing_vin_created_at_idx RENAME TO fact_listing_unpartitioned_vin_created_at_idx;
+    END IF;
+END $$;
+
 CREATE TABLE IF NOT EXISTS fact_listing (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     listing_id BIGINT,
-    created_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL,
     price REAL,
     expected_price REAL,
     price_diff_percent REAL,
     deal_rating TEXT,
     save_count INTEGER,
     vin TEXT references dim_car(vin) ON DELETE CASCADE,
-    seller_id BIGINT references dim_seller(seller_id) ON DELETE SET NULL
+    seller_id BIGINT references dim_seller(seller_id) ON DELETE SET NULL,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Rows outside of every monthly partition land here. The loader creates monthly
+-- partitions ahead of time, so this normally stays empty
+CREATE TABLE IF NOT EXISTS fact_listing_default PARTITION OF fact_listing DEFAULT;
+
+-- Create the monthly partition holding the given timestamp, if it does not exist yet.
+-- Rows of that month already in the default partition are moved into it, as the
+-- partition could not be created over them
+CREATE OR REPLACE FUNCTION ensure_fact_listing_partition(ts TIMESTAMP) RETURNS TEXT AS $$
+DECLARE
+    lower_bound TIMESTAMP := date_trunc('month', ts);
+    upper_bound TIMESTAMP := date_trunc('month', ts) + INTERVAL '1 month';
+    partition_name TEXT := 'fact_listing_y' || to_char(ts, 'YYYY') || 'm' || to_char(ts, 'MM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM fact_listing_default WHERE created_at >= lower_bound AND created_at < upper_bound) THEN
+        EXECUTE format('CREATE TABLE %I (LIKE fact_listing INCLUDING DEFAULTS)', partition_name);
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM fact_listing_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+            'INSERT INTO %I SELECT * FROM moved',
+            lower_bound, upper_bound, partition_name
+        );
+        EXECUTE format(
+            'ALTER TABLE fact_listing ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+            partition_name, lower_bound, upper_bound
+        );
+    ELSE
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF fact_listing FOR VALUES FROM (%L) TO (%L)',
+            partition_name, lower_bound, upper_bound
+        );
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    month TIMESTAMP;
+BEGIN
+    IF to_regclass('fact_listing_unpartitioned') IS NOT NULL THEN
+        FOR month IN
+            SELECT DISTINCT date_trunc('month', created_at) FROM fact_listing_unpartitioned
+        LOOP
+            PERFORM ensure_fact_listing_partition(month);
+        END LOOP;
+
+        INSERT INTO fact_listing (id, listing_id, created_at, price, expected_price, price_diff_percent, deal_rating, save_count, vin, seller_id)
+        SELECT id, listing_id, created_at, price, expected_price, price_diff_percent, deal_rating, save_count, vin, seller_id
+        FROM fact_listing_unpartitioned;
+
+        PERFORM setval(
+            pg_get_serial_sequence('fact_listing', 'id'),
+            (SELECT COALESCE(max(id), 0) + 1 FROM fact_listing),
+            false
+        );
+        DROP TABLE fact_listing_unpartitioned;
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS fact_listing_vin_created_at_idx ON fact_listing (vin, created_at) INCLUDE (price, save_count);
+
+-- Latest listing snapshot per car, maintained incrementally by the loader.
+CREATE TABLE IF NOT EXISTS fact_latest_listing (
+    vin TEXT PRIMARY KEY references dim_car(vin) ON DELETE CASCADE,
+    listing_id BIGINT,
+    created_at TIMESTAMP,
+    price REAL,
+    expected_price REAL,
+    price_diff_percent REAL,
+    deal_rating TEXT,
+    save_count INTEGER,
+    seller_id BIGINT references dim_seller(seller_id) ON DELETE SET NULL,
+    first_seen_at TIMESTAMP,
+    first_price REAL
 );
 
+CREATE INDEX IF NOT EXISTS fact_latest_listing_created_at_idx ON fact_latest_listing (created_at);
+
+-- Backfill the latest listing of every car already in fact_listing
+INSERT INTO fact_latest_listing (vin, listing_id, created_at, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id, first_seen_at, first_price)
+SELECT DISTINCT ON (f.vin)
+    f.vin, f.listing_id, f.created_at, f.price, f.expected_price, f.price_diff_percent, f.deal_rating, f.save_count, f.seller_id,
+    first.created_at, first.price
+FROM fact_listing f
+    CROSS JOIN LATERAL (
+        SELECT created_at, price FROM fact_listing
+        WHERE vin = f.vin
+        ORDER BY created_at ASC
+        LIMIT 1
+    ) first
+WHERE f.vin IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM fact_latest_listing)
+ORDER BY f.vin, f.created_at DESC;
+
+-- Latest snapshot of each car per day, e.g. for a car's price and saves over time
+CREATE OR REPLACE VIEW fact_latest_listing_per_date AS
+SELECT DISTINCT ON (vin, created_at::date)
+    id, listing_id, created_at, price, expected_price, price_diff_percent, deal_rating, save_count, vin, seller_id
+FROM fact_listing
+ORDER BY vin, created_at::date, created_at DESC;
+
 CREATE TABLE IF NOT EXISTS car_options (
     id SERIAL PRIMARY KEY,
     option_name TEXT UNIQUE
-)
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS car_option_map (
+    vin TEXT REFERENCES dim_car(vin) ON DELETE CASCADE,
+    option_id INTEGER REFERENCES car_options(id) ON DELETE CASCADE,
+    PRIMARY KEY (vin, option_id)
+);
+
+CREATE INDEX IF NOT EXISTS car_option_map_option_id_idx ON car_option_map (option_id, vin);
+
+-- Backfill the bridge table from the options arrays already stored in dim_car
+INSERT INTO car_options (option_name)
+SELECT DISTINCT unnest(options) FROM dim_car
+ON CONFLICT (option_name) DO NOTHING;
+
+INSERT INTO car_option_map (vin, option_id)
+SELECT c.vin, o.id
+FROM dim_car c
+    CROSS JOIN LATERAL unnest(c.options) AS u(option_name)
+    JOIN car_options o ON o.option_name = u.option_name
+ON CONFLICT DO NOTHING;
+
+-- Mileage band and price bucket of a listing, as used by the market analysis charts
+CREATE OR REPLACE FUNCTION market_mileage_band(mileage INTEGER) RETURNS SMALLINT AS $$
+    SELECT CASE
+        WHEN mileage < 30000 THEN 1
+        WHEN mileage <= 50000 THEN 2
+        WHEN mileage <= 70000 THEN 3
+        WHEN mileage <= 90000 THEN 4
+        WHEN mileage <= 110000 THEN 5
+        ELSE 6
+    END::SMALLINT
+$$ LANGUAGE sql IMMUTABLE;
+
+-- 5,000 wide buckets: 0 is <= 5,000, 12 is above 60,000
+CREATE OR REPLACE FUNCTION market_price_bucket(price REAL) RETURNS SMALLINT AS $$
+    SELECT LEAST(GREATEST(CEIL(price / 5000) - 1, 0), 12)::SMALLINT
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Latest listing of each car with its market cube cell
+CREATE OR REPLACE VIEW market_cube_listing AS
+SELECT
+    f.vin, c.make, c.model, c.year_release,
+    market_mileage_band(c.mileage) AS mileage_band,
+    h.owner_count, h.accident_count,
+    market_price_bucket(f.price) AS price_bucket,
+    f.price, c.mileage, f.save_count, h.days_on_cargurus
+FROM fact_latest_listing f
+    JOIN dim_car c ON c.vin = f.vin
+    LEFT JOIN dim_history h ON h.vin = f.vin
+WHERE f.price IS NOT NULL
+    AND c.make IS NOT NULL
+    AND c.model IS NOT NULL
+    AND c.year_release IS NOT NULL
+    AND c.mileage IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS dim_car_make_model_year_idx ON dim_car (make, model, year_release);
+
+-- Pre-aggregated market of the latest listings, one row per cell. The loader refreshes
+-- the cells touched by each run. Cells are small, so each keeps its sorted prices and
+-- medians over any set of cells stay exact
+CREATE TABLE IF NOT EXISTS agg_market_cube (
+    make TEXT NOT NULL,
+    model TEXT NOT NULL,
+    year_release INTEGER NOT NULL,
+    mileage_band SMALLINT NOT NULL,
+    owner_count INTEGER,
+    accident_count INTEGER,
+    price_bucket SMALLINT NOT NULL,
+    listing_count INTEGER NOT NULL,
+    price_sum DOUBLE PRECISION,
+    price_min REAL,
+    price_max REAL,
+    prices REAL[],
+    mileage_sum BIGINT,
+    save_count_sum BIGINT,
+    days_on_cargurus_sum BIGINT,
+    days_on_cargurus_count INTEGER,
+    refreshed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS agg_market_cube_make_model_year_idx ON agg_market_cube (make, model, year_release);
+
+-- Build every cell from the latest listings already loaded
+INSERT INTO agg_market_cube
+SELECT
+    make, model, year_release, mileage_band, owner_count, accident_count, price_bucket,
+    count(*), sum(price), min(price), max(price), array_agg(price ORDER BY price),
+    sum(mileage), sum(save_count), sum(days_on_cargurus), count(days_on_cargurus),
+    now()
+FROM market_cube_listing
+WHERE NOT EXISTS (SELECT 1 FROM agg_market_cube)
+GROUP BY make, model, year_release, mileage_band, owner_count, accident_count, price_bucket;
+
+-- Listing state history as intervals: one row per run of identical snapshots of a car.
+-- valid_to is when the next state was first seen, NULL while the state is current
+CREATE TABLE IF NOT EXISTS fact_price_history (
+    vin TEXT NOT NULL references dim_car(vin) ON DELETE CASCADE,
+    listing_id BIGINT,
+    price REAL,
+    expected_price REAL,
+    price_diff_percent REAL,
+    deal_rating TEXT,
+    save_count INTEGER,
+    seller_id BIGINT references dim_seller(seller_id) ON DELETE SET NULL,
+    valid_from TIMESTAMP NOT NULL,
+    valid_to TIMESTAMP,
+    last_seen_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (vin, valid_from)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS fact_price_history_open_idx ON fact_price_history (vin) WHERE valid_to IS NULL;
+
+-- Compact the snapshots already in fact_listing into intervals, once
+INSERT INTO fact_price_history (vin, listing_id, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id, valid_from, valid_to, last_seen_at)
+WITH marked AS (
+    SELECT *,
+        md5(ROW(listing_id, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id)::text)
+            IS DISTINCT FROM
+        lag(md5(ROW(listing_id, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id)::text))
+            OVER (PARTITION BY vin ORDER BY created_at) AS starts
+    FROM fact_listing
+    WHERE vin IS NOT NULL
+), islands AS (
+    SELECT *,
+        count(*) FILTER (WHERE starts) OVER (PARTITION BY vin ORDER BY created_at) AS island
+    FROM marked
+), states AS (
+    SELECT DISTINCT ON (vin, island)
+        vin, island, listing_id, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id,
+        created_at AS valid_from,
+        max(created_at) OVER (PARTITION BY vin, island) AS last_seen_at
+    FROM islands
+    ORDER BY vin, island, created_at
+)
+SELECT vin, listing_id, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id,
+    valid_from,
+    lead(valid_from) OVER (PARTITION BY vin ORDER BY island),
+    last_seen_at
+FROM states
+WHERE NOT EXISTS (SELECT 1 FROM fact_price_history);
@@ -0,0 +1,230 @@
+from functools import lru_cache
+from datetime import datetime
+import msgspec
+import time
+
+
+# CarGurus detail payload. Only the fields we read are declared, msgspec skips the rest
+# of the (large) response without building objects for it
+class FuelEconomy(msgspec.Struct):
+    value: int | float | None = None
+
+
+class ListingHistory(msgspec.Struct):
+    daysAtDealer: int | None = None
+    daysOnCarGurus: int | None = None
+
+
+class VehicleHistory(msgspec.Struct):
+    accidentCount: int | None = None
+    ownerCount: int | None = None
+    hasVehicleHistoryReport: bool | None = None
+    hasThirdPartyVehicleDamageData: bool | None = None
+    isFleet: bool | None = False
+
+
+class Listing(msgspec.Struct):
+    listingHistory: ListingHistory
+    vehicleHistory: VehicleHistory
+    id: int | str | None = None
+    price: int | float | None = None
+    expectedPrice: int | float | None = None
+    dealRatingKey: str | None = None
+    savedCount: int | None = None
+    vin: str | None = None
+    listingTitleOnly: str | None = None
+    makeName: str | None = None
+    modelName: str | None = None
+    year: int | None = None
+    trimName: str | None = None
+    mileage: int | float | None = None
+    vehicleCondition: str | None = None
+    localizedExteriorColor: str | None = None
+    localizedInteriorColor: str | None = None
+    localizedEngineDisplayName: str | None = None
+    localizedDriveTrain: str | None = None
+    localizedTransmission: str | None = None
+    cityFuelEconomy: FuelEconomy = msgspec.field(default_factory=FuelEconomy)
+    highwayFuelEconomy: FuelEconomy = msgspec.field(default_factory=FuelEconomy)
+    combinedFuelEconomy: FuelEconomy = msgspec.field(default_factory=FuelEconomy)
+    localizedFuelType: str | None = None
+    options: list[str] | None = None
+
+
+class Address(msgspec.Struct):
+    street: str | None = None
+    cityRegion: str | None = None
+    postalCode: str | None = None
+
+
+class Seller(msgspec.Struct):
+    listingSellerId: int | str | None = None
+    sellerType: str | None = None
+    name: str | None = None
+    address: Address = msgspec.field(default_factory=Address)
+    phoneNumber: str | None = None
+    isFranchiseDealer: bool | None = False
+    averageRating: int | float | None = None
+    reviewCount: int | None = None
+
+
+class AutoEntityInfo(msgspec.Struct):
+    bodyStyle: str | None = None
+
+
+class DetailsPayload(msgspec.Struct):
+    listing: Listing
+    seller: Seller
+    autoEntityInfo: AutoEntityInfo = msgspec.field(default_factory=AutoEntityInfo)
+
+
+# Extracted record, same layout as main_extract.parse_details. No reference cycles,
+# so the records can stay out of the garbage collector
+class PriceInfoRecord(msgspec.Struct, gc=False):
+    price: int | float | None
+    expectedPrice: int | float | None
+    dealRating: str | None
+    savedCount: int | None
+
+
+class SpecsRecord(msgspec.Struct, gc=False):
+    vin: str | None
+    fullName: str | None
+    url: str
+    make: str | None
+    model: str | None
+    year: int | None
+    trimName: str | None
+    mileage: int | float | None
+    condition: str | None
+    bodyType: str | None
+    exteriorColor: str | None
+    interiorColor: str | None
+    engine: str | None
+    driveTrain: str | None
+    transmission: str | None
+    mpgCity: int | float | None
+    mpgHighway: int | float | None
+    mpgCombined: int | float | None
+    fuelType: str | None
+    options: list[str] | None
+
+
+class HistoryRecord(msgspec.Struct, gc=False):
+    daysAtDealer: int | None
+    daysOnCarGurus: int | None
+    accidentCount: int | None
+    ownerCount: int | None
+    hasVehicleHistoryReport: bool | None
+    hasThirdPartyVehicleDamageData: bool | None
+    isFleetVehicle: bool | None
+
+
+class SellerRecord(msgspec.Struct, gc=False):
+    sellerId: int | str | None
+    sellerType: str | None
+    name: str | None
+    streetAddress: str | None
+    city: str | None
+    postalCode: str | None
+    phoneNumber: str | None
+    isFranchiseDealer: bool | None
+    avgRating: int | float | None
+    reviewCount: int | None
+
+
+class CarRecord(msgspec.Struct, gc=False):
+    listingId: int | str | None
+    timestamp: str
+    priceInfo: PriceInfoRecord
+    specs: SpecsRecord
+    history: HistoryRecord
+    seller: SellerRecord
+
+
+payload_decoder = msgspec.json.Decoder(DetailsPayload)
+
+
+@lru_cache(maxsize=1)
+def _format_timestamp(second: int):
+    return datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def current_timestamp():
+    # Records fetched within the same second share one formatted string
+    return _format_timestamp(int(time.time()))
+
+
+def decode_details(content: bytes, id: str, zip: str):
+    # Raises msgspec.ValidationError when the payload doesn't match the declared types
+    data = payload_decoder.decode(content)
+    listing = data.listing
+    listing_history = listing.listingHistory
+    vehicle_history = listing.vehicleHistory
+    seller = data.seller
+    address = seller.address
+    return CarRecord(
+        listingId=listing.id,
+        timestamp=current_timestamp(),
+        priceInfo=PriceInfoRecord(
+            price=listing.price,
+            expectedPrice=listing.expectedPrice,
+            dealRating=listing.dealRatingKey,
+            savedCount=listing.savedCount,
+        ),
+        specs=SpecsRecord(
+            vin=listing.vin,
+            fullName=listing.listingTitleOnly,
+            url=f"https://www.cargurus.com/Cars/inventorylisting/viewDetailsFilterViewInventoryListing.action?sourceContext=carGurusHomePageModel&entitySelectingHelper.selectedEntity=&zip={zip}#listing={id}",
+            make=listing.makeName,
+            model=listing.modelName,
+            year=listing.year,
+            trimName=listing.trimName,
+            mileage=listing.mileage,
+            condition=listing.vehicleCondition,
+            bodyType=data.autoEntityInfo.bodyStyle,
+            exteriorColor=listing.localizedExteriorColor,
+            interiorColor=listing.localizedInteriorColor,
+            engine=listing.localizedEngineDisplayName,
+            driveTrain=listing.localizedDriveTrain,
+            transmission=listing.localizedTransmission,
+            mpgCity=listing.cityFuelEconomy.value,
+            mpgHighway=listing.highwayFuelEconomy.value,
+            mpgCombined=listing.combinedFuelEconomy.value,
+            fuelType=listing.localizedFuelType,
+            options=listing.options,
+        ),
+        history=HistoryRecord(
+            daysAtDealer=listing_history.daysAtDealer,
+            daysOnCarGurus=listing_history.daysOnCarGurus,
+            accidentCount=vehicle_history.accidentCount,
+            ownerCount=vehicle_history.ownerCount,
+            hasVehicleHistoryReport=vehicle_history.hasVehicleHistoryReport,
+            hasThirdPartyVehicleDamageData=vehicle_history.hasThirdPartyVehicleDamageData,
+            isFleetVehicle=vehicle_history.isFleet,
+        ),
+        seller=SellerRecord(
+            sellerId=seller.listingSellerId,
+            sellerType=seller.sellerType,
+            name=seller.name,
+            streetAddress=address.street,
+            city=address.cityRegion,
+            postalCode=address.postalCode,
+            phoneNumber=seller.phoneNumber,
+            isFranchiseDealer=seller.isFranchiseDealer,
+            avgRating=seller.averageRating,
+            reviewCount=seller.reviewCount,
+        ),
+    )
+
+
+def from_dict(record: dict):
+    # Wraps a record built by main_extract.parse_details, for payloads the decoder rejects
+    return CarRecord(
+        listingId=record["listingId"],
+        timestamp=record["timestamp"],
+        priceInfo=PriceInfoRecord(**record["priceInfo"]),
+        specs=SpecsRecord(**record["specs"]),
+        history=HistoryRecord(**record["history"]),
+        seller=SellerRecord(**record["seller"]),
+    )
@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import hashlib
+import asyncio
+import msgspec
+import metrics_util
+import sqlite3
+import json
+import time
+import os
+
+
+load_dotenv()
+CACHE_PATH = os.getenv(
+    "LISTING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "listings.db"),
+)
+# Re-fetch details at least this often, even when the search tile looks unchanged
+CACHE_TTL = int(os.getenv("LISTING_CACHE_TTL", 12 * 60 * 60))
+# Forget listings not seen in any search for this long, and cap the cache size
+CACHE_MAX_AGE = int(os.getenv("LISTING_CACHE_MAX_AGE", 7 * 24 * 60 * 60))
+CACHE_MAX_ROWS = int(os.getenv("LISTING_CACHE_MAX_ROWS", 200000))
+CACHE_LOOKUPS = metrics_util.counter(
+    "listing_cache_lookups_total", "Listing cache lookups by result"
+)
+CACHE_REFRESHES = metrics_util.counter(
+    "listing_cache_refreshes_total",
+    "Fetched listings by whether the payload changed since it was cached",
+)
+
+# Search tile fields that change when the listing itself changes
+TILE_FIELDS = [
+    "price",
+    "expectedPrice",
+    "mileage",
+    "dealRating",
+    "savedCount",
+    "sellerId",
+]
+
+
+def tile_hash(tile_data: dict):
+    summary = {field: tile_data.get(field) for field in TILE_FIELDS}
+    # Without any summary field there is nothing to compare, so never skip the fetch
+    if all(value is None for value in summary.values()):
+        return None
+    return hashlib.sha1(json.dumps(summary, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ListingCache:
+    # The cache, and so the cross-region claims, is a SQLite file local to the host.
+    # Regions only share claims when their extract tasks run on the same worker;
+    # regions on other workers may fetch an overlapping listing again, and load keeps
+    # one row per VIN
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        ttl: int = CACHE_TTL,
+        max_age: int = CACHE_MAX_AGE,
+        max_rows: int = CACHE_MAX_ROWS,
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+
+        # Several extract processes share the cache, wait for each other's writes. That
+        # blocks, so calls go through `run` on a single thread off the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="listing-cache"
+        )
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS listings (
+                listing_id TEXT PRIMARY KEY,
+                tile_hash TEXT,
+                payload_hash TEXT,
+                payload TEXT,
+                fetched_at REAL,
+                seen_at REAL
+            )
+            """
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(listings)")]
+        if "payload_hash" not in columns:
+            self.conn.execute("ALTER TABLE listings ADD COLUMN payload_hash TEXT")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS listings_seen_at_idx ON listings (seen_at)"
+        )
+        # Which region of a run fetches each listing, so overlapping regions fetch it once
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS run_claims (
+                run_key TEXT,
+                listing_id TEXT,
+                owner TEXT,
+                claimed_at REAL,
+                PRIMARY KEY (run_key, listing_id)
+            )
+            """
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def run(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, method, *args
+        )
+
+    def get_fresh(self, listing_id: str, tile_hash: str):
+        # Return the cached record if the search tile is unchanged and the entry is within TTL
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT tile_hash, payload, fetched_at FROM listings WHERE listing_id = ?",
+            (listing_id,),
+        ).fetchone()
+        if (
+            row is None
+            or tile_hash is None
+            or row[0] != tile_hash
+            or now - row[2] > self.ttl
+        ):
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+
+        with self.conn:
+            self.conn.execute(
+                "UPDATE listings SET seen_at = ? WHERE listing_id = ?",
+                (now, listing_id),
+            )
+        self.hits += 1
+        CACHE_LOOKUPS.inc(result="hit")
+        return json.loads(row[1])
+
+    def put(self, listing_id: str, tile_hash: str, record):
+        # The payload is only rewritten when it changed, ignoring the fetch timestamp
+        now = time.time()
+        record = msgspec.to_builtins(record)
+        timestamp = record.pop("timestamp", None)
+        payload_hash = hashlib.sha1(
+            msgspec.json.encode(record, order="sorted")
+        ).hexdigest()
+        previous = self.conn.execute(
+            "SELECT payload_hash FROM listings WHERE listing_id = ?", (listing_id,)
+        ).fetchone()
+        if previous is not None and previous[0] == payload_hash:
+            CACHE_REFRESHES.inc(result="unchanged")
+            with self.conn:
+                self.conn.execute(
+                    """
+                    UPDATE listings SET tile_hash = ?, fetched_at = ?, seen_at = ?
+                    WHERE listing_id = ?
+                    """,
+                    (tile_hash, now, now, listing_id),
+                )
+            return
+
+        CACHE_REFRESHES.inc(result="changed")
+        record["timestamp"] = timestamp
+        payload = msgspec.json.encode(record, order="sorted").decode("utf-8")
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO listings (listing_id, tile_hash, payload_hash, payload, fetched_at, seen_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (listing_id) DO UPDATE SET
+                    tile_hash = excluded.tile_hash,
+                    payload_hash = excluded.payload_hash,
+                    payload = excluded.payload,
+                    fetched_at = excluded.fetched_at,
+                    seen_at = excluded.seen_at
+                """,
+                (listing_id, tile_hash, payload_hash, payload, now, now),
+            )
+
+    def claim(self, run_key: str, owner: str, listing_ids: list):
+        # Returns the listing ids this owner holds for the run, claiming unclaimed ones.
+        # An owner keeps its claims, so a retried region re-fetches its own listings
+        if not listing_ids:
+            return []
+
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO run_claims (run_key, listing_id, owner, claimed_at) VALUES (?, ?, ?, ?)",
+                [(run_key, listing_id, owner, now) for listing_id in listing_ids],
+            )
+            owned = self.conn.execute(
+                f"""
+                SELECT listing_id FROM run_claims
+                WHERE run_key = ? AND owner = ?
+                    AND listing_id IN ({', '.join(['?'] * len(listing_ids))})
+                """,
+                (run_key, owner, *listing_ids),
+            ).fetchall()
+        owned = {row[0] for row in owned}
+        return [listing_id for listing_id in listing_ids if listing_id in owned]
+
+    def evict(self):
+        # Drop listings not seen recently, then the least recently seen ones over the cap
+        self.conn.execute(
+            "DELETE FROM listings WHERE seen_at < ?", (time.time() - self.max_age,)
+        )
+        self.conn.execute(
+            """
+            DELETE FROM listings WHERE listing_id IN (
+                SELECT listing_id FROM listings ORDER BY seen_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_rows,),
+        )
+        self.conn.execute(
+            "DELETE FROM run_claims WHERE claimed_at < ?",
+            (time.time() - self.max_age,),
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.evict()
+        self.conn.close()
+        print(f"Listing cache: {self.hits} hits, {self.misses} misses")
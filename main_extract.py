@@ -1,207 +1,447 @@
+from concurrent.futures import ProcessPoolExecutor
 import curl_util
+import details_decoder
 from datetime import datetime
+import listing_cache
 import minio_util
+import metrics_util
 import asyncio
-import queue
+import msgspec
 import traceback
+import os
 
 
-def request_listings_api(session, zip: str, distance: str, page: int):
+# Overridable to point extraction at a stand-in server, e.g. the benchmark stub
+CARGURUS_BASE_URL = os.getenv("CARGURUS_BASE_URL", "https://www.cargurus.com")
+MAX_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", 10))
+RETRY_WORKERS = 2
+# Failed detail requests (exceptions and retryable statuses) get this many more passes
+RETRY_ATTEMPTS = 2
+# Comma separated zip:radius pairs, e.g. "75081:50,77002:50"
+EXTRACT_REGIONS = os.getenv("EXTRACT_REGIONS", "75081:50")
+# Upper bound on search pages per region, and how many pages are requested at once
+MAX_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", 100))
+PAGE_WINDOW = int(os.getenv("EXTRACT_PAGE_WINDOW", 5))
+# Listing tiles on a full search page
+PAGE_LISTINGS = 25
+# Requests per host and region. By default enough for every page of MAX_PAGES and each
+# of its listings, with every request retried RETRY_ATTEMPTS times
+HOST_REQUEST_BUDGET = int(
+    os.getenv(
+        "EXTRACT_HOST_REQUEST_BUDGET",
+        MAX_PAGES * (1 + PAGE_LISTINGS) * (1 + RETRY_ATTEMPTS),
+    )
+)
+REGION_WORKERS = int(os.getenv("EXTRACT_REGION_WORKERS", 4))
+RETRIES = metrics_util.counter(
+    "extract_retries_total", "Detail requests queued for another pass, by reason"
+)
+LISTINGS = metrics_util.counter(
+    "extract_listings_total", "Listings stored, fetched or served from the cache"
+)
+DECODE_FALLBACKS = metrics_util.counter(
+    "extract_decode_fallbacks_total", "Detail payloads the typed decoder rejected"
+)
+PAGES = metrics_util.gauge("extract_search_pages", "Search pages walked")
+
+
+def get_regions(regions: str = EXTRACT_REGIONS):
+    return [
+        {"zip": zip.strip(), "distance": distance.strip()}
+        for zip, distance in (
+            region.split(":") for region in regions.split(",") if region.strip()
+        )
+    ]
+
+
+async def request_listings_api(session, limiter, zip: str, distance: str, page: int):
     # Customizable parameters: zip, distance, pageNumber
-    api_url = f"https://www.cargurus.com/Cars/searchPage.action?zip={zip}&distance={distance}&sourceContext=carGurusHomePageModel&sortDir=ASC&sortType=BEST_MATCH&srpVariation=DEFAULT_SEARCH&isDeliveryEnabled=true&nonShippableBaseline=0&pageNumber={page}&filtersModified=true"
+    api_url = f"{CARGURUS_BASE_URL}/Cars/searchPage.action?zip={zip}&distance={distance}&sourceContext=carGurusHomePageModel&sortDir=ASC&sortType=BEST_MATCH&srpVariation=DEFAULT_SEARCH&isDeliveryEnabled=true&nonShippableBaseline=0&pageNumber={page}&filtersModified=true"
     try:
-        response = session.get(api_url)
+        async with limiter.acquire(api_url) as result:
+            response = await session.get(api_url)
+            result.status = response.status_code
+        if response.status_code != 200:
+            print(f"Search page {page} returned {response.status_code}")
+            return None
         data = response.json()
-        car_ids = []
+        # Car id -> hash of the price/summary fields visible on the search tile
+        car_tiles = {}
         for listing in data["tiles"]:
             if "MERCH" not in listing["type"]:
-                car_ids.append(str(listing["data"]["id"]))
-        return car_ids
+                car_tiles[str(listing["data"]["id"])] = listing_cache.tile_hash(
+                    listing["data"]
+                )
+        # The tile count tells a page past the last result (no tiles at all) apart
+        # from one holding only merchandising tiles
+        return len(data["tiles"]), car_tiles
+    except (curl_util.RequestBudgetExceeded, curl_util.CircuitOpen) as e:
+        print(f"Skipped search page {page}: {e}")
+        return None
     except Exception as e:
         print(f"Caught Error: {e}")
         traceback.print_exc()
+        # None tells a failed page apart from an empty one past the last result
+        return None
 
 
-def request_details_api(
-    session, id: str, zip: str, distance: str, retry_q: queue.Queue = None
+async def request_details_api(
+    session,
+    limiter,
+    id: str,
+    zip: str,
+    distance: str,
+    retry_q: asyncio.Queue = None,
+    attempt: int = 0,
+    failed: dict = None,
 ):
+    # Listings that will not turn up on another attempt (e.g. a 404 or a payload that
+    # can't be decoded) are added to failed with the reason
     # Customizable parameters: inventoryListing (car id), searchZip, searchDistance
-    api_url = f"https://www.cargurus.com/Cars/detailListingJson.action?inventoryListing={id}&searchZip={zip}&searchDistance={distance}&inclusionType=DEFAULT&pid=null&sourceContext=carGurusHomePageModel&isDAVE=false"
+    api_url = f"{CARGURUS_BASE_URL}/Cars/detailListingJson.action?inventoryListing={id}&searchZip={zip}&searchDistance={distance}&inclusionType=DEFAULT&pid=null&sourceContext=carGurusHomePageModel&isDAVE=false"
+    retry = retry_q is not None and attempt < RETRY_ATTEMPTS
     try:
-        response = session.get(api_url)
+        async with limiter.acquire(api_url) as result:
+            response = await session.get(api_url)
+            result.status = response.status_code
+    except (curl_util.RequestBudgetExceeded, curl_util.CircuitOpen) as e:
+        print(f"Skipped id {id}: {e}")
+        return {}
     except Exception as e:
         print(f"Caught Error: {e}")
         traceback.print_exc()
-        if retry_q is not None:
-            retry_q.put(id)
+        if retry:
+            await retry_q.put((id, attempt + 1))
+            RETRIES.inc(reason="exception")
             print(f"Added id {id} into retry queue")
         return {}
 
     if response.status_code == 200:
-        data = response.json()
-        listing = data["listing"]
-        seller = data["seller"]
-        return {
-            "listingId": listing.get("id", None),
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "priceInfo": {
-                "price": listing.get("price", None),
-                "expectedPrice": listing.get("expectedPrice", None),
-                "dealRating": listing.get("dealRatingKey", None),
-                "savedCount": listing.get("savedCount", None),
-            },
-            "specs": {
-                "vin": listing.get("vin", None),
-                "fullName": listing.get("listingTitleOnly", None),
-                "url": f"https://www.cargurus.com/Cars/inventorylisting/viewDetailsFilterViewInventoryListing.action?sourceContext=carGurusHomePageModel&entitySelectingHelper.selectedEntity=&zip={zip}#listing={id}",
-                "make": listing.get("makeName", None),
-                "model": listing.get("modelName", None),
-                "year": listing.get("year", None),
-                "trimName": listing.get("trimName", None),
-                "mileage": listing.get("mileage", None),
-                "condition": listing.get("vehicleCondition", None),
-                "bodyType": (
-                    data.get("autoEntityInfo").get("bodyStyle")
-                    if "bodyStyle" in data.get("autoEntityInfo")
-                    else None
-                ),
-                "exteriorColor": listing.get("localizedExteriorColor", None),
-                "interiorColor": listing.get("localizedInteriorColor", None),
-                "engine": listing.get("localizedEngineDisplayName", None),
-                "driveTrain": listing.get("localizedDriveTrain", None),
-                "transmission": listing.get("localizedTransmission", None),
-                "mpgCity": (
-                    listing.get("cityFuelEconomy").get("value")
-                    if "cityFuelEconomy" in listing
-                    else None
-                ),
-                "mpgHighway": (
-                    listing.get("highwayFuelEconomy").get("value")
-                    if "highwayFuelEconomy" in listing
-                    else None
-                ),
-                "mpgCombined": (
-                    listing.get("combinedFuelEconomy").get("value")
-                    if "combinedFuelEconomy" in listing
-                    else None
-                ),
-                "fuelType": listing.get("localizedFuelType", None),
-                "options": listing.get("options", None),
-            },
-            "history": {
-                "daysAtDealer": listing.get("listingHistory").get("daysAtDealer", None),
-                "daysOnCarGurus": listing.get("listingHistory").get(
-                    "daysOnCarGurus", None
-                ),
-                "accidentCount": (
-                    listing.get("vehicleHistory").get("accidentCount")
-                    if "accidentCount" in listing.get("vehicleHistory")
-                    else None
-                ),
-                "ownerCount": (
-                    listing.get("vehicleHistory").get("ownerCount")
-                    if "ownerCount" in listing.get("vehicleHistory")
-                    else None
-                ),
-                "hasVehicleHistoryReport": (
-                    listing.get("vehicleHistory").get("hasVehicleHistoryReport")
-                    if "hasVehicleHistoryReport" in listing.get("vehicleHistory")
-                    else None
-                ),
-                "hasThirdPartyVehicleDamageData": (
-                    listing.get("vehicleHistory").get("hasThirdPartyVehicleDamageData")
-                    if "hasThirdPartyVehicleDamageData" in listing.get("vehicleHistory")
-                    else None
-                ),
-                "isFleetVehicle": (
-                    listing.get("vehicleHistory").get("isFleet")
-                    if "isFleet" in listing.get("vehicleHistory")
-                    else False
-                ),
-            },
-            "seller": {
-                "sellerId": seller.get("listingSellerId", None),
-                "sellerType": seller.get("sellerType", None),
-                "name": seller.get("name", None),
-                "streetAddress": (
-                    seller.get("address").get("street")
-                    if "address" in seller and "street" in seller.get("address")
-                    else None
-                ),
-                "city": (
-                    seller.get("address").get("cityRegion")
-                    if "address" in seller and "cityRegion" in seller.get("address")
-                    else None
-                ),
-                "postalCode": (
-                    seller.get("address").get("postalCode")
-                    if "address" in seller and "postalCode" in seller.get("address")
-                    else None
-                ),
-                "phoneNumber": seller.get("phoneNumber", None),
-                "isFranchiseDealer": seller.get("isFranchiseDealer", False),
-                "avgRating": seller.get("averageRating", None),
-                "reviewCount": seller.get("reviewCount", None),
-            },
-        }
+        try:
+            return details_decoder.decode_details(response.content, id, zip)
+        except msgspec.ValidationError as e:
+            print(f"Falling back to untyped parsing for id {id}: {e}")
+            DECODE_FALLBACKS.inc()
+        except msgspec.DecodeError as e:
+            # Not JSON at all, e.g. an anti-bot page served with a 200
+            print(f"Skipped id {id}: undecodable response ({e})")
+            if failed is not None:
+                failed[id] = "undecodable"
+            return {}
+        try:
+            return details_decoder.from_dict(parse_details(response.json(), id, zip))
+        except Exception as e:
+            print(f"Skipped id {id}: unparseable details ({e!r})")
+            if failed is not None:
+                failed[id] = "unparseable"
+            return {}
+    elif response.status_code in curl_util.RETRY_STATUSES and retry:
+        await retry_q.put((id, attempt + 1))
+        RETRIES.inc(reason=str(response.status_code))
+        print(f"Added id {id} into retry queue after status {response.status_code}")
+    elif response.status_code not in curl_util.RETRY_STATUSES:
+        print(f"Skipped id {id}: status {response.status_code}")
+        if failed is not None:
+            failed[id] = f"status {response.status_code}"
     else:
-        print(response.status_code)
-        return {}
+        print(f"Gave up on id {id} after status {response.status_code}")
+    return {}
 
 
-async def extract():
-    zip = "75081"
-    distance = "50"
-    session = curl_util.get_curl_session()
-    retry_queue = queue.Queue()
+def parse_details(data: dict, id: str, zip: str):
+    listing = data["listing"]
+    seller = data["seller"]
+    return {
+        "listingId": listing.get("id", None),
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "priceInfo": {
+            "price": listing.get("price", None),
+            "expectedPrice": listing.get("expectedPrice", None),
+            "dealRating": listing.get("dealRatingKey", None),
+            "savedCount": listing.get("savedCount", None),
+        },
+        "specs": {
+            "vin": listing.get("vin", None),
+            "fullName": listing.get("listingTitleOnly", None),
+            "url": f"https://www.cargurus.com/Cars/inventorylisting/viewDetailsFilterViewInventoryListing.action?sourceContext=carGurusHomePageModel&entitySelectingHelper.selectedEntity=&zip={zip}#listing={id}",
+            "make": listing.get("makeName", None),
+            "model": listing.get("modelName", None),
+            "year": listing.get("year", None),
+            "trimName": listing.get("trimName", None),
+            "mileage": listing.get("mileage", None),
+            "condition": listing.get("vehicleCondition", None),
+            "bodyType": (
+                data.get("autoEntityInfo").get("bodyStyle")
+                if "bodyStyle" in data.get("autoEntityInfo")
+                else None
+            ),
+            "exteriorColor": listing.get("localizedExteriorColor", None),
+            "interiorColor": listing.get("localizedInteriorColor", None),
+            "engine": listing.get("localizedEngineDisplayName", None),
+            "driveTrain": listing.get("localizedDriveTrain", None),
+            "transmission": listing.get("localizedTransmission", None),
+            "mpgCity": (
+                listing.get("cityFuelEconomy").get("value")
+                if "cityFuelEconomy" in listing
+                else None
+            ),
+            "mpgHighway": (
+                listing.get("highwayFuelEconomy").get("value")
+                if "highwayFuelEconomy" in listing
+                else None
+            ),
+            "mpgCombined": (
+                listing.get("combinedFuelEconomy").get("value")
+                if "combinedFuelEconomy" in listing
+                else None
+            ),
+            "fuelType": listing.get("localizedFuelType", None),
+            "options": listing.get("options", None),
+        },
+        "history": {
+            "daysAtDealer": listing.get("listingHistory").get("daysAtDealer", None),
+            "daysOnCarGurus": listing.get("listingHistory").get("daysOnCarGurus", None),
+            "accidentCount": (
+                listing.get("vehicleHistory").get("accidentCount")
+                if "accidentCount" in listing.get("vehicleHistory")
+                else None
+            ),
+            "ownerCount": (
+                listing.get("vehicleHistory").get("ownerCount")
+                if "ownerCount" in listing.get("vehicleHistory")
+                else None
+            ),
+            "hasVehicleHistoryReport": (
+                listing.get("vehicleHistory").get("hasVehicleHistoryReport")
+                if "hasVehicleHistoryReport" in listing.get("vehicleHistory")
+                else None
+            ),
+            "hasThirdPartyVehicleDamageData": (
+                listing.get("vehicleHistory").get("hasThirdPartyVehicleDamageData")
+                if "hasThirdPartyVehicleDamageData" in listing.get("vehicleHistory")
+                else None
+            ),
+            "isFleetVehicle": (
+                listing.get("vehicleHistory").get("isFleet")
+                if "isFleet" in listing.get("vehicleHistory")
+                else False
+            ),
+        },
+        "seller": {
+            "sellerId": seller.get("listingSellerId", None),
+            "sellerType": seller.get("sellerType", None),
+            "name": seller.get("name", None),
+            "streetAddress": (
+                seller.get("address").get("street")
+                if "address" in seller and "street" in seller.get("address")
+                else None
+            ),
+            "city": (
+                seller.get("address").get("cityRegion")
+                if "address" in seller and "cityRegion" in seller.get("address")
+                else None
+            ),
+            "postalCode": (
+                seller.get("address").get("postalCode")
+                if "address" in seller and "postalCode" in seller.get("address")
+                else None
+            ),
+            "phoneNumber": seller.get("phoneNumber", None),
+            "isFranchiseDealer": seller.get("isFranchiseDealer", False),
+            "avgRating": seller.get("averageRating", None),
+            "reviewCount": seller.get("reviewCount", None),
+        },
+    }
+
+
+async def extract(
+    zip: str = "75081",
+    distance: str = "50",
+    time_frame: str = None,
+    concurrency: int = MAX_CONCURRENCY,
+    host_budget: int = HOST_REQUEST_BUDGET,
+    max_pages: int = MAX_PAGES,
+):
+    source = "cargurus"
+    time_frame = time_frame or datetime.now().strftime("%Y-%m-%d/%H")
+    region = f"{zip}-{distance}"
+    limiter = curl_util.AdaptiveLimiter(concurrency, host_budget)
+    retry_queue = asyncio.Queue()
+    tile_hashes = {}
     unique_cars = set()
-    for current_page in range(1, 10 + 1):
-        # Fetch car ids from current search page
-        car_ids = request_listings_api(session, zip, distance, current_page)
-
-        # Extract and upload all car data on current page
-        for id in car_ids:
-            car_data = request_details_api(session, id, zip, distance, retry_queue)
-            if car_data:
-                unique_cars.add(car_data["specs"]["vin"])
-                asyncio.create_task(
-                    minio_util.upload_json(
-                        source="cargurus",
-                        car_vin=car_data["specs"]["vin"],
-                        car_data=car_data,
-                    )
+    # Set when a search page fails, the region then can't be marked complete
+    incomplete = False
+    # Search pages this attempt got back, checkpointed ones are not requested again
+    pages_walked = 0
+
+    # A retried task of the same run resumes from the region's checkpoint
+    checkpoint = minio_util.Checkpoint.load(source, time_frame, region)
+    manifest_name = f"{source}/{time_frame}/manifests/{region}.json"
+    if checkpoint.complete:
+        print(f"Region {region} already extracted for {time_frame}")
+        return minio_util.write_manifest(manifest_name, checkpoint.manifest())
+    if checkpoint.shards:
+        print(
+            f"Resuming region {region}: {len(checkpoint.pages)} pages and "
+            f"{len(checkpoint.listing_ids)} listings already persisted"
+        )
+    checkpoint.discard_unconfirmed_shards()
+
+    async with minio_util.Uploader() as uploader, minio_util.ShardWriter(
+        uploader,
+        source=source,
+        time_frame=time_frame,
+        writer_id=region,
+        checkpoint=checkpoint,
+    ) as writer, curl_util.SessionPool(max_clients=concurrency) as session:
+        with listing_cache.ListingCache() as cache:
+
+            async def store(id, car_vin, car_data):
+                unique_cars.add(car_vin)
+                await writer.add(car_vin=car_vin, car_data=car_data, listing_id=id)
+
+            async def fetch(id, attempt=0):
+                car_data = await request_details_api(
+                    session,
+                    limiter,
+                    id,
+                    zip,
+                    distance,
+                    retry_queue,
+                    attempt,
+                    checkpoint.failed,
+                )
+                if car_data:
+                    await cache.run(cache.put, id, tile_hashes.get(id), car_data)
+                    await store(id, car_data.specs.vin, car_data)
+                    LISTINGS.inc(source="fetched")
+
+            async def scrape_page(page):
+                nonlocal incomplete, pages_walked
+                # Returns the page's tile count, None for a failed page. Pages finished
+                # by a previous attempt count as non-empty
+                if page in checkpoint.pages:
+                    return 1
+
+                # Fetch car ids from the search page, skipping ids already seen on other pages
+                result = await request_listings_api(
+                    session, limiter, zip, distance, page
                 )
+                if result is None:
+                    incomplete = True
+                    return None
+                pages_walked += 1
+                tile_count, car_tiles = result
+                if not tile_count:
+                    return 0
+                car_ids = [id for id in car_tiles if id not in tile_hashes]
+                tile_hashes.update({id: car_tiles[id] for id in car_ids})
 
-        # Retry failed car detail requests of the same page. Retry only once
-        if not retry_queue.empty():
-            while not retry_queue.empty():
-                car_data = request_details_api(
-                    session, retry_queue.get(), zip, distance
+                # Overlapping regions share the run's claims, whoever claims an id first fetches it
+                car_ids = await cache.run(
+                    cache.claim, f"{source}/{time_frame}", region, car_ids
                 )
-                if not car_data:
-                    continue
-                else:
-                    unique_cars.add(car_data["specs"]["vin"])
-                    asyncio.create_task(
-                        minio_util.upload_json(
-                            source="cargurus",
-                            car_vin=car_data["specs"]["vin"],
-                            car_data=car_data,
-                        )
-                    )
-
-        # Move to next page
-        current_page += 1
-
-    # Wait for remaining unfinished file uploads
-    all_tasks = asyncio.all_tasks()
-    main_coro = asyncio.current_task()
-    all_tasks.remove(main_coro)
-    await asyncio.wait(all_tasks)
-
-
-def run_extract_sync():
-    asyncio.run(extract())
+
+                # Listings persisted by a previous attempt are not fetched again, nor
+                # those that failed for good
+                persisted = [id for id in car_ids if id in checkpoint.listing_ids]
+                car_ids = [
+                    id
+                    for id in car_ids
+                    if id not in checkpoint.listing_ids and id not in checkpoint.failed
+                ]
+                LISTINGS.inc(len(persisted), source="checkpoint")
+                checkpoint.track_page(page, car_ids)
+
+                # Unchanged listings are snapshotted from the cache instead of re-fetched
+                to_fetch = []
+                for id in car_ids:
+                    cached = await cache.run(cache.get_fresh, id, tile_hashes[id])
+                    if cached is None:
+                        to_fetch.append(id)
+                    else:
+                        cached["timestamp"] = details_decoder.current_timestamp()
+                        await store(id, cached["specs"]["vin"], cached)
+                        LISTINGS.inc(source="cache")
+
+                # Extract and upload the remaining car data on the page concurrently
+                await asyncio.gather(*(fetch(id) for id in to_fetch))
+                return tile_count
+
+            async def retry_worker():
+                # Retry failed car detail requests as they come in, after a jittered backoff
+                while True:
+                    id, attempt = await retry_queue.get()
+                    try:
+                        await asyncio.sleep(curl_util.backoff_delay(attempt))
+                        await fetch(id, attempt)
+                    except Exception as e:
+                        # Keep the worker alive, or retry_queue.join() would wait forever
+                        print(f"Retry of id {id} failed: {e!r}")
+                        traceback.print_exc()
+                    finally:
+                        retry_queue.task_done()
+
+            retry_workers = [
+                asyncio.create_task(retry_worker()) for _ in range(RETRY_WORKERS)
+            ]
+
+            # Walk the search pages a window at a time until one comes back without any
+            # tiles. Failed pages don't end the walk unless the whole window failed
+            page = 1
+            while page <= max_pages:
+                window = range(page, min(page + PAGE_WINDOW, max_pages + 1))
+                results = await asyncio.gather(*(scrape_page(p) for p in window))
+                page = window[-1] + 1
+                if any(result == 0 for result in results) or all(
+                    result is None for result in results
+                ):
+                    break
+
+            await retry_queue.join()
+            for worker in retry_workers:
+                worker.cancel()
+            await asyncio.gather(*retry_workers, return_exceptions=True)
+            print(
+                f"Region {region}: {pages_walked} pages, {len(unique_cars)} cars, "
+                f"{len(checkpoint.failed)} listings failed for good"
+            )
+            PAGES.set(pages_walked)
+            limiter.summary()
+
+        # Leaving the contexts flushes the last shard and the index, then waits for
+        # the remaining uploads
+
+    # Saving also marks pages done by the last shard. Complete only with nothing left
+    await checkpoint.save()
+    if not incomplete and not checkpoint.page_listings and not uploader.failed:
+        checkpoint.complete = True
+        await checkpoint.save()
+
+    # The manifest lists exactly the region's persisted shards, transform reads it
+    # instead of listing the run's prefix
+    return minio_util.write_manifest(manifest_name, checkpoint.manifest())
+
+
+def run_extract_sync(zip: str = None, distance: str = None, time_frame: str = None):
+    # Returns the region's manifest object name (a list of them for every region),
+    # which Airflow hands to transform through XCom
+    if zip is None:
+        return run_extract_regions(time_frame=time_frame)
+    with metrics_util.stage("extract", region=f"{zip}-{distance}"):
+        return asyncio.run(extract(zip, distance, time_frame))
+
+
+def run_extract_regions(regions: list = None, time_frame: str = None):
+    # One process per region, all sharing the run's time frame and listing claims
+    regions = regions or get_regions()
+    time_frame = time_frame or datetime.now().strftime("%Y-%m-%d/%H")
+    with ProcessPoolExecutor(max_workers=min(REGION_WORKERS, len(regions))) as pool:
+        futures = [
+            pool.submit(run_extract_sync, region["zip"], region["distance"], time_frame)
+            for region in regions
+        ]
+        return [future.result() for future in futures]
 
 
 if __name__ == "__main__":
@@ -1,192 +1,730 @@
 import os
-import ast
+import re
+import gzip
+import time
 import psycopg
+import tempfile
 import pandas as pd
+from psycopg import errors
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from datetime import datetime
-from minio_util import download_csv
+from minio_util import download_parquet, read_manifest, read_parquet, upload_file
+import metrics_util
 
 
 load_dotenv()
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PWD = os.getenv("POSTGRES_PWD")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", 5432))
+POSTGRES_DB = os.getenv("POSTGRES_DB", "used_cars")
+# Months of fact_listing partitions to keep attached, unset keeps everything
+RETENTION_MONTHS = os.getenv("FACT_LISTING_RETENTION_MONTHS")
+# Listing history kept per run: "snapshots" appends every snapshot to fact_listing,
+# "intervals" only extends or opens fact_price_history intervals, "both" does both
+PRICE_HISTORY_MODE = os.getenv("PRICE_HISTORY_MODE", "both")
+# Cars are split by VIN hash into LOAD_PARTITIONS, each merged in its own transaction
+# by one of LOAD_WORKERS parallel workers
+LOAD_PARTITIONS = int(os.getenv("LOAD_PARTITIONS", 8))
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", min(4, os.cpu_count() or 1)))
+LOAD_ATTEMPTS = 3
+LOAD_BACKOFF = 1
+LOAD_ROWS = metrics_util.counter("load_rows_total", "Rows merged per table and action")
+LOAD_RETRIES = metrics_util.counter(
+    "load_retries_total", "Load transactions retried after a serialization failure"
+)
 
 
-def load():
-    # Download the CSV file from MinIO into a DataFrame
-    source = "cargurus"
-    time_frame = datetime.now().strftime("%Y-%m-%d/%H")
-    df = download_csv(source, time_frame)
+# Table column -> DataFrame column, key column first
+DIM_CAR_COLUMNS = {
+    "vin": "specs.vin",
+    "full_name": "specs.fullName",
+    "page_url": "specs.url",
+    "make": "specs.make",
+    "model": "specs.model",
+    "year_release": "specs.year",
+    "trim_name": "specs.trimName",
+    "mileage": "specs.mileage",
+    "mileage_per_year": "specs.mileagePerYear",
+    "condition": "specs.condition",
+    "body_type": "specs.bodyType",
+    "exterior_color": "specs.exteriorColor",
+    "interior_color": "specs.interiorColor",
+    "engine": "specs.engine",
+    "fuel_type": "specs.fuelType",
+    "drivetrain": "specs.driveTrain",
+    "transmission": "specs.transmission",
+    "mpg_city": "specs.mpgCity",
+    "mpg_highway": "specs.mpgHighway",
+    "mpg_combined": "specs.mpgCombined",
+    "options": "specs.options",
+    "engine_displacement": "specs.engineDisplacement",
+    "engine_configuration": "specs.engineConfiguration",
+    "engine_cylinders": "specs.engineCylinders",
+    "engine_horsepower": "specs.engineHorsepower",
+    "engine_torque": "specs.engineTorque",
+    "engine_aspiration": "specs.engineAspiration",
+    "transmission_type": "specs.transmissionType",
+    "transmission_speeds": "specs.transmissionSpeeds",
+    "row_hash": "dim_car.rowHash",
+}
+DIM_HISTORY_COLUMNS = {
+    "vin": "specs.vin",
+    "days_at_dealer": "history.daysAtDealer",
+    "days_on_cargurus": "history.daysOnCarGurus",
+    "accident_count": "history.accidentCount",
+    "owner_count": "history.ownerCount",
+    "has_vehicle_history_report": "history.hasVehicleHistoryReport",
+    "has_thirdparty_vehicle_damage_report": "history.hasThirdPartyVehicleDamageData",
+    "is_fleet_vehicle": "history.isFleetVehicle",
+    "row_hash": "dim_history.rowHash",
+}
+DIM_SELLER_COLUMNS = {
+    "seller_id": "seller.sellerId",
+    "seller_type": "seller.sellerType",
+    "seller_name": "seller.name",
+    "street_address": "seller.streetAddress",
+    "city": "seller.city",
+    "postal_code": "seller.postalCode",
+    "phone_number": "seller.phoneNumber",
+    "is_franchise_dealer": "seller.isFranchiseDealer",
+    "avg_rating": "seller.avgRating",
+    "review_count": "seller.reviewCount",
+    "row_hash": "dim_seller.rowHash",
+}
+FACT_LISTING_COLUMNS = {
+    "listing_id": "listingId",
+    "created_at": "timestamp",
+    "price": "priceInfo.price",
+    "expected_price": "priceInfo.expectedPrice",
+    "price_diff_percent": "priceInfo.priceDiffPercent",
+    "deal_rating": "priceInfo.dealRating",
+    "save_count": "priceInfo.savedCount",
+    "vin": "specs.vin",
+    "seller_id": "seller.sellerId",
+}
+CAR_OPTION_MAP_COLUMNS = {
+    "vin": "specs.vin",
+    "option_id": "option_id",
+}
+PRICE_STATE_COLUMNS = [
+    "listing_id",
+    "price",
+    "expected_price",
+    "price_diff_percent",
+    "deal_rating",
+    "save_count",
+    "seller_id",
+]
+MARKET_CUBE_KEY = [
+    "make",
+    "model",
+    "year_release",
+    "mileage_band",
+    "owner_count",
+    "accident_count",
+    "price_bucket",
+]
 
-    # Convert specs.options from string representation of list to actual list
-    df["specs.options"] = df["specs.options"].apply(
-        lambda x: ast.literal_eval(x) if pd.notna(x) else []
-    )
 
-    # Cast all columns to object type and replace NaN with None for PostgreSQL type adaptation
-    df = df.astype(object).where(pd.notna(df), None)
+class OptionIdCache:
+    def __init__(self):
+        # Option name -> car_options.id
+        self.ids = {}
 
-    # Load the DataFrame into PostgreSQL
-    db_params = {
-        "dbname": "used_cars",
+    def preload(self, cur):
+        cur.execute("SELECT option_name, id FROM car_options")
+        self.ids = dict(cur.fetchall())
+
+    def resolve(self, cur, names: list):
+        # Only names not seen before go to the database
+        unseen = [name for name in names if name not in self.ids]
+        if unseen:
+            cur.execute(
+                """
+                INSERT INTO car_options (option_name)
+                SELECT unnest(%s::text[])
+                ON CONFLICT (option_name) DO NOTHING
+                RETURNING option_name, id
+                """,
+                [unseen],
+            )
+            self.ids.update(cur.fetchall())
+
+            # Names inserted concurrently by someone else are not returned above
+            missing = [name for name in unseen if name not in self.ids]
+            if missing:
+                cur.execute(
+                    "SELECT option_name, id FROM car_options WHERE option_name = ANY(%s)",
+                    [missing],
+                )
+                self.ids.update(cur.fetchall())
+        return len(unseen)
+
+
+option_ids = OptionIdCache()
+
+
+def get_db_params():
+    return {
+        "dbname": POSTGRES_DB,
         "user": POSTGRES_USER,
         "password": POSTGRES_PWD,
-        "host": "localhost",
-        "port": 5432,
+        "host": POSTGRES_HOST,
+        "port": POSTGRES_PORT,
     }
-    with psycopg.connect(**db_params) as conn:
-        with conn.cursor() as cur:
-            dim_car_cols = [
-                "full_name",
-                "page_url",
-                "make",
-                "model",
-                "year_release",
-                "trim_name",
-                "mileage",
-                "mileage_per_year",
-                "condition",
-                "body_type",
-                "exterior_color",
-                "interior_color",
-                "engine",
-                "fuel_type",
-                "drivetrain",
-                "transmission",
-                "mpg_city",
-                "mpg_highway",
-                "mpg_combined",
-                "options",
-            ]
-            dim_history_cols = [
-                "days_at_dealer",
-                "days_on_cargurus",
-                "accident_count",
-                "owner_count",
-                "has_vehicle_history_report",
-                "has_thirdparty_vehicle_damage_report",
-                "is_fleet_vehicle",
-            ]
-            dim_seller_cols = [
-                "seller_type",
-                "seller_name",
-                "street_address",
-                "city",
-                "postal_code",
-                "phone_number",
-                "is_franchise_dealer",
-                "avg_rating",
-                "review_count",
-            ]
 
-            for _, row in df.iterrows():
-                cur.execute(
-                    f"""
-                    INSERT INTO dim_car (vin, {', '.join(dim_car_cols)})
-                    VALUES ({', '.join(['%s'] * (len(dim_car_cols) + 1))})
-                    ON CONFLICT (vin) DO UPDATE
-                    SET {', '.join([f"{col} = EXCLUDED.{col}" for col in dim_car_cols])}
-                    """,
-                    [
-                        row["specs.vin"],
-                        row["specs.fullName"],
-                        row["specs.url"],
-                        row["specs.make"],
-                        row["specs.model"],
-                        row["specs.year"],
-                        row["specs.trimName"],
-                        row["specs.mileage"],
-                        row["specs.mileagePerYear"],
-                        row["specs.condition"],
-                        row["specs.bodyType"],
-                        row["specs.exteriorColor"],
-                        row["specs.interiorColor"],
-                        row["specs.engine"],
-                        row["specs.fuelType"],
-                        row["specs.driveTrain"],
-                        row["specs.transmission"],
-                        row["specs.mpgCity"],
-                        row["specs.mpgHighway"],
-                        row["specs.mpgCombined"],
-                        row["specs.options"],
-                    ],
-                )
 
-                # Insert car history data
-                cur.execute(
-                    f"""
-                    INSERT INTO dim_history (vin, {', '.join(dim_history_cols)})
-                    VALUES ({', '.join(['%s'] * (len(dim_history_cols) + 1))})
-                    ON CONFLICT (vin) DO UPDATE
-                    SET {', '.join([f"{col} = EXCLUDED.{col}" for col in dim_history_cols])}
-                    """,
-                    [
-                        row["specs.vin"],
-                        row["history.daysAtDealer"],
-                        row["history.daysOnCarGurus"],
-                        row["history.accidentCount"],
-                        row["history.ownerCount"],
-                        row["history.hasVehicleHistoryReport"],
-                        row["history.hasThirdPartyVehicleDamageData"],
-                        row["history.isFleetVehicle"],
-                    ],
+def row_hash(df: pd.DataFrame, columns: dict):
+    # 64-bit hash of every mapped column except the hash itself, one value per row
+    values = df[[col for key, col in columns.items() if key != "row_hash"]]
+    if "specs.options" in values:
+        values = values.assign(
+            **{"specs.options": values["specs.options"].str.join("|")}
+        )
+    hashes = pd.util.hash_pandas_object(values, index=False)
+    return hashes.to_numpy().view("int64")
+
+
+def to_db_values(df: pd.DataFrame):
+    # Cast all columns to object type and replace NaN with None for PostgreSQL type adaptation
+    return df.astype(object).where(pd.notna(df), None)
+
+
+def stage_table(cur, table: str, columns: dict, df: pd.DataFrame):
+    # Create a temp table with the target column types and COPY the rows into it
+    stage_name = f"stage_{table}"
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE {stage_name} ON COMMIT DROP AS
+        SELECT {', '.join(columns.keys())} FROM {table} WITH NO DATA
+        """
+    )
+    rows = df[list(columns.values())].itertuples(index=False, name=None)
+    with cur.copy(
+        f"COPY {stage_name} ({', '.join(columns.keys())}) FROM STDIN"
+    ) as copy:
+        for row in rows:
+            copy.write_row(row)
+    return stage_name
+
+
+def merge_table(cur, table: str, columns: dict, key: str = None, unique: list = None):
+    # Merge the staged rows into the target table in one statement. Rows whose stored
+    # hash matches the staged one are left untouched
+    table_cols = list(columns.keys())
+    sql = f"""
+        INSERT INTO {table} ({', '.join(table_cols)})
+        SELECT {', '.join(table_cols)} FROM stage_{table} s
+        """
+    if unique is not None:
+        # Appends skip rows already stored, so a retried load doesn't add them twice
+        sql += f"""
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table} t WHERE {' AND '.join(f"t.{col} = s.{col}" for col in unique)}
+        )
+        """
+    if key is not None:
+        sql += f"""
+        ON CONFLICT ({key}) DO UPDATE
+        SET {', '.join([f"{col} = EXCLUDED.{col}" for col in table_cols if col != key])}
+        """
+        if "row_hash" in columns:
+            sql += f"WHERE {table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash"
+
+    return count_merge(
+        cur,
+        sql,
+        f"SELECT count(*) FROM stage_{table}",
+        # Plain appends only insert, and partitioned tables have no xmax to check
+        inserted="xmax = 0" if key is not None else "true",
+    )
+
+
+def count_merge(cur, sql: str, staged_sql: str, inserted: str = "xmax = 0"):
+    # Run an INSERT ... ON CONFLICT statement and count what it did with the staged rows.
+    # Returns a function reading the counts, so the statement can be pipelined
+    cur.execute(
+        f"""
+        WITH merged AS ({sql} RETURNING ({inserted}) AS inserted)
+        SELECT
+            ({staged_sql}),
+            count(*) FILTER (WHERE inserted),
+            count(*) FILTER (WHERE NOT inserted)
+        FROM merged
+        """
+    )
+
+    def read():
+        staged, inserted, updated = cur.fetchone()
+        return {
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": staged - inserted - updated,
+        }
+
+    return read
+
+
+def ensure_partitions(cur, timestamps: pd.Series):
+    # Monthly partitions for every month in the run, plus the next one ahead of time
+    months = set(timestamps.dropna().dt.to_period("M"))
+    if months:
+        months.add(max(months) + 1)
+    for month in sorted(months):
+        cur.execute("SELECT ensure_fact_listing_partition(%s)", [month.to_timestamp()])
+
+
+def merge_latest_listing(cur):
+    # Move each car touched by the run to its newest snapshot, keeping when and at
+    # what price it was first seen. Reloading the same snapshot leaves the row as is
+    sql = """
+        INSERT INTO fact_latest_listing (vin, listing_id, created_at, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id, first_seen_at, first_price)
+        SELECT DISTINCT ON (vin)
+            vin, listing_id, created_at, price, expected_price, price_diff_percent, deal_rating, save_count, seller_id,
+            min(created_at) OVER (PARTITION BY vin),
+            first_value(price) OVER (PARTITION BY vin ORDER BY created_at ASC)
+        FROM stage_fact_listing
+        WHERE vin IS NOT NULL
+        ORDER BY vin, created_at DESC
+        ON CONFLICT (vin) DO UPDATE
+        SET listing_id = EXCLUDED.listing_id,
+            created_at = EXCLUDED.created_at,
+            price = EXCLUDED.price,
+            expected_price = EXCLUDED.expected_price,
+            price_diff_percent = EXCLUDED.price_diff_percent,
+            deal_rating = EXCLUDED.deal_rating,
+            save_count = EXCLUDED.save_count,
+            seller_id = EXCLUDED.seller_id
+        WHERE fact_latest_listing.created_at < EXCLUDED.created_at
+            OR (
+                fact_latest_listing.created_at = EXCLUDED.created_at
+                AND (
+                    fact_latest_listing.listing_id, fact_latest_listing.price, fact_latest_listing.expected_price,
+                    fact_latest_listing.price_diff_percent, fact_latest_listing.deal_rating,
+                    fact_latest_listing.save_count, fact_latest_listing.seller_id
+                ) IS DISTINCT FROM (
+                    EXCLUDED.listing_id, EXCLUDED.price, EXCLUDED.expected_price,
+                    EXCLUDED.price_diff_percent, EXCLUDED.deal_rating,
+                    EXCLUDED.save_count, EXCLUDED.seller_id
                 )
+            )
+        """
+    return count_merge(cur, sql, "SELECT count(DISTINCT vin) FROM stage_fact_listing")
 
-                # Insert seller data
-                cur.execute(
-                    f"""
-                    INSERT INTO dim_seller (seller_id, {', '.join(dim_seller_cols)})
-                    VALUES ({', '.join(['%s'] * (len(dim_seller_cols) + 1))})
-                    ON CONFLICT (seller_id) DO UPDATE
-                    SET {', '.join([f"{col} = EXCLUDED.{col}" for col in dim_seller_cols])}
-                    """,
-                    [
-                        row["seller.sellerId"],
-                        row["seller.sellerType"],
-                        row["seller.name"],
-                        row["seller.streetAddress"],
-                        row["seller.city"],
-                        row["seller.postalCode"],
-                        row["seller.phoneNumber"],
-                        row["seller.isFranchiseDealer"],
-                        (
-                            round(row["seller.avgRating"], 2)
-                            if row["seller.avgRating"]
-                            else None
-                        ),
-                        row["seller.reviewCount"],
-                    ],
+
+def price_state(alias: str):
+    # One comparable value per listing state, NULL-safe
+    columns = ", ".join(f"{alias}.{col}" for col in PRICE_STATE_COLUMNS)
+    return f"md5(ROW({columns})::text)"
+
+
+def merge_price_history(cur):
+    # Collapse the run's snapshots of each car into runs of identical states, skipping
+    # snapshots not newer than what the open interval already covers
+    state_cols = ", ".join(PRICE_STATE_COLUMNS)
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE stage_price_states ON COMMIT DROP AS
+        WITH observed AS (
+            SELECT s.*, {price_state("s")} AS state
+            FROM stage_fact_listing s
+                LEFT JOIN fact_price_history h ON h.vin = s.vin AND h.valid_to IS NULL
+            WHERE s.vin IS NOT NULL
+                AND (h.last_seen_at IS NULL OR s.created_at > h.last_seen_at)
+        ), marked AS (
+            SELECT *,
+                state IS DISTINCT FROM lag(state) OVER (PARTITION BY vin ORDER BY created_at) AS starts
+            FROM observed
+        ), islands AS (
+            SELECT *, count(*) FILTER (WHERE starts) OVER (PARTITION BY vin ORDER BY created_at) AS island
+            FROM marked
+        ), states AS (
+            SELECT DISTINCT ON (vin, island)
+                vin, island, state, {state_cols},
+                created_at AS valid_from,
+                max(created_at) OVER (PARTITION BY vin, island) AS last_seen_at
+            FROM islands
+            ORDER BY vin, island, created_at
+        )
+        SELECT *,
+            lead(valid_from) OVER (PARTITION BY vin ORDER BY island) AS valid_to,
+            false AS has_open,
+            false AS extends
+        FROM states
+        """
+    )
+
+    # A car whose first state in the run matches its open interval extends it
+    cur.execute(
+        f"""
+        UPDATE stage_price_states f
+        SET has_open = true, extends = f.state = {price_state("h")}
+        FROM fact_price_history h
+        WHERE h.vin = f.vin AND h.valid_to IS NULL AND f.island = 1
+        """
+    )
+    cur.execute(
+        """
+        UPDATE fact_price_history h
+        SET last_seen_at = CASE WHEN f.extends THEN f.last_seen_at ELSE h.last_seen_at END,
+            valid_to = CASE WHEN f.extends THEN f.valid_to ELSE f.valid_from END
+        FROM stage_price_states f
+        WHERE h.vin = f.vin AND h.valid_to IS NULL AND f.island = 1
+        """
+    )
+    cur.execute(
+        f"""
+        INSERT INTO fact_price_history ({state_cols}, vin, valid_from, valid_to, last_seen_at)
+        SELECT {state_cols}, vin, valid_from, valid_to, last_seen_at
+        FROM stage_price_states
+        WHERE NOT extends
+        """
+    )
+    cur.execute(
+        """
+        SELECT
+            count(*) FILTER (WHERE extends),
+            count(*) FILTER (WHERE has_open AND NOT extends),
+            count(*) FILTER (WHERE NOT extends)
+        FROM stage_price_states
+        """
+    )
+
+    def read():
+        extended, closed, opened = cur.fetchone()
+        return {"extended": extended, "closed": closed, "opened": opened}
+
+    return read
+
+
+def create_cube_cells_table(cur):
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE IF NOT EXISTS touched_cube_cells ON COMMIT DROP AS
+        SELECT {', '.join(MARKET_CUBE_KEY)} FROM agg_market_cube WITH NO DATA
+        """
+    )
+
+
+def collect_cube_cells(cur):
+    # Market cube cells of the run's cars. Called before and after the merges, so both
+    # the cells the cars leave and the ones they move into are refreshed
+    create_cube_cells_table(cur)
+    cur.execute(
+        f"""
+        INSERT INTO touched_cube_cells
+        SELECT DISTINCT {', '.join(MARKET_CUBE_KEY)}
+        FROM market_cube_listing
+        WHERE vin IN (SELECT vin FROM stage_dim_car)
+        """
+    )
+
+
+def cube_cell_match(alias: str):
+    # Owner and accident counts may be NULL, the other key columns never are
+    return " AND ".join(
+        (
+            f"{alias}.{col} IS NOT DISTINCT FROM t.{col}"
+            if col in ("owner_count", "accident_count")
+            else f"{alias}.{col} = t.{col}"
+        )
+        for col in MARKET_CUBE_KEY
+    )
+
+
+def refresh_market_cube(cur):
+    # Recompute the touched cells from the latest listings, dropping emptied ones
+    cur.execute("ANALYZE touched_cube_cells")
+    cur.execute(
+        f"""
+        DELETE FROM agg_market_cube a
+        USING (SELECT DISTINCT * FROM touched_cube_cells) t
+        WHERE {cube_cell_match("a")}
+        """
+    )
+    insert_cur = cur.connection.cursor()
+    insert_cur.execute(
+        f"""
+        INSERT INTO agg_market_cube
+        SELECT
+            {', '.join(MARKET_CUBE_KEY)},
+            count(*), sum(price), min(price), max(price), array_agg(price ORDER BY price),
+            sum(mileage), sum(save_count), sum(days_on_cargurus), count(days_on_cargurus),
+            now()
+        FROM market_cube_listing l
+        WHERE EXISTS (SELECT 1 FROM touched_cube_cells t WHERE {cube_cell_match("l")})
+        GROUP BY {', '.join(MARKET_CUBE_KEY)}
+        """
+    )
+    return {"deleted": cur.rowcount, "inserted": insert_cur.rowcount}
+
+
+def replace_option_links(cur):
+    # Replace the option links of every car in the run
+    cur.execute(
+        """
+        DELETE FROM car_option_map m
+        USING stage_dim_car s
+        WHERE m.vin = s.vin
+            AND NOT EXISTS (
+                SELECT 1 FROM stage_car_option_map n
+                WHERE n.vin = m.vin AND n.option_id = m.option_id
+            )
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO car_option_map (vin, option_id)
+        SELECT vin, option_id FROM stage_car_option_map
+        ON CONFLICT DO NOTHING
+        """
+    )
+    return lambda: {"inserted": cur.rowcount}
+
+
+def run_transaction(pool: ConnectionPool, work, *args):
+    # Run work(conn, *args) in one transaction, retried from the start when it loses
+    # to a concurrent transaction
+    for attempt in range(1, LOAD_ATTEMPTS + 1):
+        try:
+            with pool.connection() as conn:
+                return work(conn, *args)
+        except (errors.SerializationFailure, errors.DeadlockDetected) as e:
+            if attempt == LOAD_ATTEMPTS:
+                raise
+            print(f"Retrying {work.__name__} after {type(e).__name__}")
+            LOAD_RETRIES.inc(step=work.__name__)
+            time.sleep(LOAD_BACKOFF * 2 ** (attempt - 1))
+
+
+def load_shared(conn, sellers: pd.DataFrame, option_names: list, timestamps):
+    # Rows shared by cars of every partition, written before the partitions
+    with conn.cursor() as cur:
+        # Map option names to ids, inserting only names never seen before
+        option_ids.preload(cur)
+        new_options = option_ids.resolve(cur, option_names)
+        if PRICE_HISTORY_MODE != "intervals":
+            ensure_partitions(cur, timestamps)
+        stage_table(cur, "dim_seller", DIM_SELLER_COLUMNS, sellers)
+        row_counts = {
+            "car_options": {"inserted": new_options},
+            "dim_seller": merge_table(
+                cur, "dim_seller", DIM_SELLER_COLUMNS, key="seller_id"
+            )(),
+        }
+    return row_counts
+
+
+def load_partition(
+    conn, cars: pd.DataFrame, listings: pd.DataFrame, car_options: pd.DataFrame
+):
+    # Merge one VIN partition of the run. Returns its row counts and the market cube
+    # cells it touched
+    with conn.cursor() as cur:
+        stage_table(cur, "dim_car", DIM_CAR_COLUMNS, cars)
+        stage_table(cur, "dim_history", DIM_HISTORY_COLUMNS, cars)
+        stage_table(cur, "fact_listing", FACT_LISTING_COLUMNS, listings)
+        stage_table(cur, "car_option_map", CAR_OPTION_MAP_COLUMNS, car_options)
+
+    # The merges go out back to back in pipeline mode, cars before what references
+    # them, and their counts are read once every statement has been sent
+    with conn.pipeline():
+        collect_cube_cells(conn.cursor())
+        results = {
+            "dim_car": merge_table(
+                conn.cursor(), "dim_car", DIM_CAR_COLUMNS, key="vin"
+            ),
+            "dim_history": merge_table(
+                conn.cursor(), "dim_history", DIM_HISTORY_COLUMNS, key="vin"
+            ),
+            "fact_latest_listing": merge_latest_listing(conn.cursor()),
+        }
+        if PRICE_HISTORY_MODE != "intervals":
+            results["fact_listing"] = merge_table(
+                conn.cursor(),
+                "fact_listing",
+                FACT_LISTING_COLUMNS,
+                unique=["vin", "created_at"],
+            )
+        if PRICE_HISTORY_MODE != "snapshots":
+            results["fact_price_history"] = merge_price_history(conn.cursor())
+        results["car_option_map"] = replace_option_links(conn.cursor())
+        collect_cube_cells(conn.cursor())
+        cells = conn.cursor()
+        cells.execute("SELECT DISTINCT * FROM touched_cube_cells")
+    return {table: read() for table, read in results.items()}, cells.fetchall()
+
+
+def load_market_cube(conn, cells: set):
+    # The partitions share cells, so the cube is refreshed once they are all merged
+    with conn.cursor() as cur:
+        create_cube_cells_table(cur)
+        with cur.copy(
+            f"COPY touched_cube_cells ({', '.join(MARKET_CUBE_KEY)}) FROM STDIN"
+        ) as copy:
+            for cell in cells:
+                copy.write_row(cell)
+        return refresh_market_cube(cur)
+
+
+def vin_partitions(vins: pd.Series, partitions: int):
+    # Stable partition number of each VIN
+    return pd.util.hash_array(vins.to_numpy(dtype=object)) % partitions
+
+
+@metrics_util.stage("load")
+def load(time_frame: str = None, manifest: str = None):
+    # Download the transformed Parquet data from MinIO into a DataFrame, the objects
+    # listed by the transform manifest when given
+    source = "cargurus"
+    time_frame = time_frame or datetime.now().strftime("%Y-%m-%d/%H")
+    if manifest is not None:
+        objects = read_manifest(manifest)["objects"]
+        df = pd.concat([read_parquet(obj["key"]) for obj in objects], ignore_index=True)
+    else:
+        df = download_parquet(source, time_frame)
+
+    # Parquet list cells come back as arrays, PostgreSQL adapts plain lists
+    df["specs.options"] = df["specs.options"].apply(
+        lambda x: list(x) if x is not None else []
+    )
+    df["seller.avgRating"] = df["seller.avgRating"].round(2)
+
+    # Each car and seller is written once per run, with its latest data in the run
+    df = df.sort_values("timestamp", kind="stable")
+    cars = df.drop_duplicates("specs.vin", keep="last").copy()
+    sellers = (
+        df[df["seller.sellerId"].notna()]
+        .drop_duplicates("seller.sellerId", keep="last")
+        .copy()
+    )
+
+    # Hash the dimension rows, so unchanged rows can be skipped by the merge
+    cars["dim_car.rowHash"] = row_hash(cars, DIM_CAR_COLUMNS)
+    cars["dim_history.rowHash"] = row_hash(cars, DIM_HISTORY_COLUMNS)
+    sellers["dim_seller.rowHash"] = row_hash(sellers, DIM_SELLER_COLUMNS)
+
+    run_timestamps = df["timestamp"]
+    df = to_db_values(df)
+    cars = to_db_values(cars)
+    sellers = to_db_values(sellers)
+    car_options = cars[["specs.vin", "specs.options"]].explode("specs.options")
+    car_options = car_options[car_options["specs.options"].notna()]
+
+    listing_partition = vin_partitions(df["specs.vin"], LOAD_PARTITIONS)
+    car_partition = vin_partitions(cars["specs.vin"], LOAD_PARTITIONS)
+    option_partition = vin_partitions(car_options["specs.vin"], LOAD_PARTITIONS)
+
+    conninfo = make_conninfo(**get_db_params())
+    with ConnectionPool(
+        conninfo, min_size=1, max_size=LOAD_WORKERS, open=False
+    ) as pool:
+        # Sellers and options first, every partition references them
+        row_counts = run_transaction(
+            pool,
+            load_shared,
+            sellers,
+            car_options["specs.options"].unique().tolist(),
+            run_timestamps,
+        )
+        car_options = car_options.assign(
+            option_id=car_options["specs.options"].map(option_ids.ids)
+        )
+
+        # Then the cars and their listings, one transaction per VIN partition
+        cells = set()
+        with ThreadPoolExecutor(
+            max_workers=LOAD_WORKERS, thread_name_prefix="load"
+        ) as executor:
+            futures = [
+                executor.submit(
+                    run_transaction,
+                    pool,
+                    load_partition,
+                    cars[car_partition == partition],
+                    df[listing_partition == partition],
+                    car_options[option_partition == partition],
                 )
+                for partition in range(LOAD_PARTITIONS)
+                if (car_partition == partition).any()
+            ]
+            for future in as_completed(futures):
+                partition_counts, partition_cells = future.result()
+                cells.update(partition_cells)
+                for table, counts in partition_counts.items():
+                    totals = row_counts.setdefault(table, {})
+                    for action, count in counts.items():
+                        totals[action] = totals.get(action, 0) + count
+
+        row_counts["agg_market_cube"] = run_transaction(pool, load_market_cube, cells)
+
+    print(f"Loaded {len(df)} listings")
+    for table, counts in row_counts.items():
+        print(f"  {table}: {', '.join(f'{k} {v}' for k, v in counts.items())}")
+        for action, count in counts.items():
+            LOAD_ROWS.inc(count, table=table, action=action)
+
 
-                # Insert car listing data
+def archive_partition(cur, partition_name: str):
+    # Stream the partition as gzipped CSV through a temp file into the bucket
+    with tempfile.NamedTemporaryFile(suffix=".csv.gz") as tmp:
+        with gzip.open(tmp.name, "wb") as gz:
+            with cur.copy(
+                f"COPY {partition_name} TO STDOUT WITH (FORMAT csv, HEADER)"
+            ) as copy:
+                for data in copy:
+                    gz.write(data)
+        upload_file(
+            object_name=f"archive/fact_listing/{partition_name}.csv.gz",
+            file_path=tmp.name,
+            content_type="application/gzip",
+        )
+
+
+@metrics_util.stage("retention")
+def apply_retention(retention_months: int = None, archive: bool = True):
+    # Detach and drop monthly fact_listing partitions older than the retention window,
+    # archiving each one to MinIO first
+    if retention_months is None:
+        if RETENTION_MONTHS is None:
+            print("No fact_listing retention configured")
+            return []
+        retention_months = int(RETENTION_MONTHS)
+
+    cutoff = pd.Timestamp.now().to_period("M") - retention_months
+    dropped = []
+    with psycopg.connect(**get_db_params(), autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT c.relname
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'fact_listing'::regclass
+                ORDER BY c.relname
+                """
+            )
+            for (partition_name,) in cur.fetchall():
+                match = re.fullmatch(r"fact_listing_y(\d{4})m(\d{2})", partition_name)
+                if match is None:
+                    continue
+                month = pd.Period(year=int(match[1]), month=int(match[2]), freq="M")
+                if month >= cutoff:
+                    continue
+
+                # Archive while still attached, so a failed upload leaves the data in place
+                if archive:
+                    archive_partition(cur, partition_name)
                 cur.execute(
-                    """
-                    INSERT INTO fact_listing (listing_id, created_at, price, expected_price, price_diff_percent, deal_rating, save_count, vin, seller_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    [
-                        row["listingId"],
-                        row["timestamp"],
-                        row["priceInfo.price"],
-                        row["priceInfo.expectedPrice"],
-                        row["priceInfo.priceDiffPercent"],
-                        row["priceInfo.dealRating"],
-                        row["priceInfo.savedCount"],
-                        row["specs.vin"],
-                        row["seller.sellerId"],
-                    ],
+                    f"ALTER TABLE fact_listing DETACH PARTITION {partition_name}"
                 )
-
-                # Insert new unique car option(s)
-                for option in row["specs.options"]:
-                    cur.execute(
-                        """
-                        INSERT INTO car_options (option_name)
-                        VALUES (%s)
-                        ON CONFLICT (option_name) DO NOTHING
-                        """,
-                        [option],
-                    )
+                cur.execute(f"DROP TABLE {partition_name}")
+                dropped.append(partition_name)
+                print(f"Dropped fact_listing partition {partition_name}")
+    return dropped
 
 
 if __name__ == "__main__":
@@ -4,9 +4,9 @@ from airflow.providers.standard.operators.python import PythonOperator
 import sys
 
 sys.path.insert(0, "/home/hayden_huynh/Projects/Used-Car-Market-Analysis")
-from main_extract import run_extract_sync
+from main_extract import run_extract_sync, get_regions
 from main_transform import transform
-from main_load import load
+from main_load import load, apply_retention
 
 default_args = {
     "owner": "airflow",
@@ -18,6 +18,10 @@ default_args = {
     "priority_weight": 1000000,
 }
 
+# Every task (and every retry) of a run works on the same time frame, so a retried
+# extract finds its checkpoint and transform/load read what extract wrote
+RUN_TIME_FRAME = "{{ (logical_date or dag_run.run_after).strftime('%Y-%m-%d/%H') }}"
+
 with DAG(
     "cargurus_used_cars",
     default_args=default_args,
@@ -26,21 +30,38 @@ with DAG(
     start_date=datetime(2025, 11, 1, 0, 0),
     catchup=False,
     tags=["ETL", "CarGurus", "Used Cars"],
+    # XCom values (manifest object names) reach the callables as Python objects
+    render_template_as_native_obj=True,
 ) as dag:
 
-    extract_data = PythonOperator(
+    # One mapped extract task per configured region
+    extract_data = PythonOperator.partial(
         task_id="extract_data",
         python_callable=run_extract_sync,
-    )
+        op_kwargs={"time_frame": RUN_TIME_FRAME},
+    ).expand(op_args=[[region["zip"], region["distance"]] for region in get_regions()])
 
     transform_data = PythonOperator(
         task_id="transform_data",
         python_callable=transform,
+        op_kwargs={
+            "time_frame": RUN_TIME_FRAME,
+            "manifests": "{{ ti.xcom_pull(task_ids='extract_data') | list }}",
+        },
     )
 
     load_data = PythonOperator(
         task_id="load_data",
         python_callable=load,
+        op_kwargs={
+            "time_frame": RUN_TIME_FRAME,
+            "manifest": "{{ ti.xcom_pull(task_ids='transform_data') }}",
+        },
+    )
+
+    fact_listing_retention = PythonOperator(
+        task_id="fact_listing_retention",
+        python_callable=apply_retention,
     )
 
-    extract_data >> transform_data >> load_data
+    extract_data >> transform_data >> load_data >> fact_listing_retention
@@ -1,72 +1,373 @@
 from datetime import datetime
 from dotenv import load_dotenv
+from itertools import islice
 import curl_util
 import minio_util
+import metrics_util
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import tempfile
+import os
+import re
 
 
 load_dotenv()
 curl_session = curl_util.get_curl_session()
+# Records transformed and written per output part, bounds the stage's memory use
+CHUNK_RECORDS = int(os.getenv("TRANSFORM_CHUNK_RECORDS", 10000))
+TRANSFORM_RECORDS = metrics_util.counter(
+    "transform_records_total", "Records read, and objects that couldn't be read"
+)
 
 
-def transform():
-    source = "cargurus"
-    time_frame = datetime.now().strftime("%Y-%m-%d/%H")
+# Explicit schema of the combined run file handed over to the load step
+COMBINED_SCHEMA = pa.schema(
+    [
+        ("listingId", pa.int64()),
+        ("timestamp", pa.timestamp("s")),
+        ("priceInfo.price", pa.float64()),
+        ("priceInfo.expectedPrice", pa.float64()),
+        ("priceInfo.dealRating", pa.string()),
+        ("priceInfo.savedCount", pa.int64()),
+        ("priceInfo.priceDiffPercent", pa.float64()),
+        ("specs.vin", pa.string()),
+        ("specs.fullName", pa.string()),
+        ("specs.url", pa.string()),
+        ("specs.make", pa.string()),
+        ("specs.model", pa.string()),
+        ("specs.year", pa.int64()),
+        ("specs.trimName", pa.string()),
+        ("specs.mileage", pa.int64()),
+        ("specs.mileagePerYear", pa.float64()),
+        ("specs.condition", pa.string()),
+        ("specs.bodyType", pa.string()),
+        ("specs.exteriorColor", pa.string()),
+        ("specs.interiorColor", pa.string()),
+        ("specs.engine", pa.string()),
+        ("specs.driveTrain", pa.string()),
+        ("specs.transmission", pa.string()),
+        ("specs.mpgCity", pa.float64()),
+        ("specs.mpgHighway", pa.float64()),
+        ("specs.mpgCombined", pa.float64()),
+        ("specs.engineDisplacement", pa.float64()),
+        ("specs.engineConfiguration", pa.string()),
+        ("specs.engineCylinders", pa.int64()),
+        ("specs.engineHorsepower", pa.int64()),
+        ("specs.engineTorque", pa.int64()),
+        ("specs.engineAspiration", pa.string()),
+        ("specs.transmissionType", pa.string()),
+        ("specs.transmissionSpeeds", pa.int64()),
+        ("specs.fuelType", pa.string()),
+        ("specs.options", pa.list_(pa.string())),
+        ("history.daysAtDealer", pa.int64()),
+        ("history.daysOnCarGurus", pa.int64()),
+        ("history.accidentCount", pa.int64()),
+        ("history.ownerCount", pa.int64()),
+        ("history.hasVehicleHistoryReport", pa.bool_()),
+        ("history.hasThirdPartyVehicleDamageData", pa.bool_()),
+        ("history.isFleetVehicle", pa.bool_()),
+        ("seller.sellerId", pa.int64()),
+        ("seller.sellerType", pa.string()),
+        ("seller.name", pa.string()),
+        ("seller.streetAddress", pa.string()),
+        ("seller.city", pa.string()),
+        ("seller.postalCode", pa.string()),
+        ("seller.phoneNumber", pa.string()),
+        ("seller.isFranchiseDealer", pa.bool_()),
+        ("seller.avgRating", pa.float64()),
+        ("seller.reviewCount", pa.int64()),
+    ]
+)
 
-    records = minio_util.download_json(source=source, time_frame=time_frame)
 
-    df = pd.json_normalize(records)
+REQUIRED_COLUMNS = [
+    "specs.vin",
+    "priceInfo.price",
+    "priceInfo.expectedPrice",
+    "specs.make",
+    "specs.model",
+    "specs.year",
+    "specs.mileage",
+]
+
+
+class CachedParser:
+    def __init__(self, parse):
+        # parse() maps a Series of unique strings to a DataFrame of parsed columns
+        self.parse = parse
+        self.cache = parse(pd.Series([], dtype="string"))
+
+    def __call__(self, values: pd.Series):
+        # Parse only the distinct values not seen before, then map results back to rows
+        values = values.astype("string")
+        unseen = pd.Index(values.dropna().unique()).difference(self.cache.index)
+        if len(unseen) > 0:
+            parsed = self.parse(pd.Series(unseen, index=unseen, dtype="string"))
+            self.cache = parsed if self.cache.empty else pd.concat([self.cache, parsed])
+        return self.cache.reindex(values.to_numpy()).set_axis(values.index)
+
+
+def parse_engine(engines: pd.Series):
+    # e.g. "2.0L I4 Turbo", "306 hp 3.5L V6", "5.0L V8 400hp 410ft. lbs."
+    layout = engines.str.extract(
+        r"\b(?P<configuration>V|I|W|H|Flat|Inline)[- ]?(?P<cylinders>\d{1,2})\b",
+        flags=re.IGNORECASE,
+    )
+    displacement = pd.to_numeric(
+        engines.str.extract(r"(\d+(?:\.\d+)?)\s*L\b", expand=False)
+    )
+    aspiration = np.select(
+        [
+            engines.str.contains("turbo", case=False, na=False).to_numpy(bool),
+            engines.str.contains("supercharg", case=False, na=False).to_numpy(bool),
+            displacement.notna().to_numpy(),
+        ],
+        ["Turbocharged", "Supercharged", "Naturally Aspirated"],
+        default=None,
+    )
+    return pd.DataFrame(
+        {
+            "specs.engineDisplacement": displacement.astype("float64"),
+            "specs.engineConfiguration": layout["configuration"]
+            .str.upper()
+            .replace({"INLINE": "I", "FLAT": "H"}),
+            "specs.engineCylinders": pd.to_numeric(layout["cylinders"]).astype("Int64"),
+            "specs.engineHorsepower": pd.to_numeric(
+                engines.str.extract(
+                    r"(\d{2,4})\s*hp\b", flags=re.IGNORECASE, expand=False
+                )
+            ).astype("Int64"),
+            "specs.engineTorque": pd.to_numeric(
+                engines.str.extract(
+                    r"(\d{2,4})\s*(?:ft\.?\s*lbs?|lb-?ft)",
+                    flags=re.IGNORECASE,
+                    expand=False,
+                )
+            ).astype("Int64"),
+            "specs.engineAspiration": pd.Series(
+                aspiration, index=engines.index, dtype="string"
+            ),
+        },
+        index=engines.index,
+    )
+
+
+def parse_transmission(transmissions: pd.Series):
+    # e.g. "8-Speed Automatic", "6-Speed Manual", "Continuously Variable Transmission (CVT)"
+    lower = transmissions.str.lower()
+    transmission_type = np.select(
+        [
+            lower.str.contains("cvt|continuously variable", na=False).to_numpy(bool),
+            lower.str.contains("dual.clutch|dct", na=False).to_numpy(bool),
+            lower.str.contains("manual", na=False).to_numpy(bool),
+            lower.str.contains("automatic", na=False).to_numpy(bool),
+        ],
+        ["CVT", "Dual-Clutch", "Manual", "Automatic"],
+        default=None,
+    )
+    return pd.DataFrame(
+        {
+            "specs.transmissionType": pd.Series(
+                transmission_type, index=transmissions.index, dtype="string"
+            ),
+            "specs.transmissionSpeeds": pd.to_numeric(
+                lower.str.extract(r"(\d{1,2})[- ]?speed", expand=False)
+            ).astype("Int64"),
+        },
+        index=transmissions.index,
+    )
 
-    # Filter out records without one or more of: VIN, price, make, model, year, mileage
-    df = df[
-        df[
-            [
-                "specs.vin",
-                "priceInfo.price",
-                "priceInfo.expectedPrice",
-                "specs.make",
-                "specs.model",
-                "specs.year",
-                "specs.mileage",
-            ]
-        ]
-        .notnull()
-        .all(axis=1)
-    ]
 
-    # Enrich the data
-    ## Add actual vs expected price difference percentage
+engine_parser = CachedParser(parse_engine)
+transmission_parser = CachedParser(parse_transmission)
+
+
+def add_price_diff_percent(df: pd.DataFrame):
+    expected_price = df["priceInfo.expectedPrice"]
     df["priceInfo.priceDiffPercent"] = (
-        df["priceInfo.expectedPrice"] - df["priceInfo.price"]
-    ) / df["priceInfo.expectedPrice"]
-    df["priceInfo.priceDiffPercent"] = df["priceInfo.priceDiffPercent"].apply(
-        lambda x: round(x * 100, 2)
+        (expected_price - df["priceInfo.price"]) / expected_price * 100
+    ).round(2)
+    return df
+
+
+def add_mileage_per_year(df: pd.DataFrame, reference_year: int):
+    # Cars of the reference year keep their total mileage
+    age = reference_year - df["specs.year"]
+    df["specs.mileagePerYear"] = (
+        (df["specs.mileage"] / age.where(age != 0)).round(2).fillna(df["specs.mileage"])
     )
+    return df
+
+
+def impute_mpg(df: pd.DataFrame):
+    # Missing combined figures are filled from city and highway (combined = .55 * city
+    # + .45 * highway). City and highway are only ever stored as observed
+    city = df["specs.mpgCity"].astype("float64")
+    highway = df["specs.mpgHighway"].astype("float64")
+    combined = df["specs.mpgCombined"].astype("float64")
+    df["specs.mpgCombined"] = combined.fillna((0.55 * city + 0.45 * highway).round(1))
+    return df
 
-    ## Add mileage per year
-    df["specs.mileagePerYear"] = df.apply(
-        lambda row: (
-            round(row["specs.mileage"] / (datetime.now().year - row["specs.year"]), 2)
-            if (datetime.now().year - row["specs.year"]) != 0
-            else row["specs.mileage"]
-        ),
-        axis=1,
+
+def add_engine_specs(df: pd.DataFrame):
+    specs = engine_parser(df["specs.engine"])
+    df[specs.columns] = specs
+    return df
+
+
+def add_transmission_specs(df: pd.DataFrame):
+    specs = transmission_parser(df["specs.transmission"])
+    df[specs.columns] = specs
+    return df
+
+
+def apply_rules(df: pd.DataFrame, reference_year: int):
+    # Filter out records without one or more of: VIN, price, make, model, year, mileage
+    df = df[df[REQUIRED_COLUMNS].notnull().all(axis=1)].copy()
+
+    # Enrich the data, each rule is one column expression over the whole batch
+    df = add_price_diff_percent(df)
+    df = add_mileage_per_year(df, reference_year)
+    df = impute_mpg(df)
+    df = add_engine_specs(df)
+    df = add_transmission_specs(df)
+    return df
+
+
+def conform_to_schema(df: pd.DataFrame, schema: pa.Schema):
+    # Select the schema columns in order and cast them to matching nullable dtypes
+    df = df.reindex(columns=schema.names)
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            df[field.name] = df[field.name].astype("Int64")
+        elif pa.types.is_floating(field.type):
+            df[field.name] = df[field.name].astype("float64")
+        elif pa.types.is_boolean(field.type):
+            df[field.name] = df[field.name].astype("boolean")
+        elif pa.types.is_string(field.type):
+            df[field.name] = df[field.name].astype("string")
+        elif pa.types.is_timestamp(field.type):
+            df[field.name] = pd.to_datetime(df[field.name])
+        elif pa.types.is_list(field.type):
+            # A missing column comes back from reindex as float NaN, which pyarrow
+            # cannot convert to a list
+            df[field.name] = df[field.name].astype(object)
+    return df
+
+
+def chunks(records, size: int):
+    records = iter(records)
+    while chunk := list(islice(records, size)):
+        yield chunk
+
+
+def transform_chunk(records: list, reference_year: int):
+    df = pd.json_normalize(records)
+    df = apply_rules(df, reference_year=reference_year)
+
+    # Cast all columns to the types of the combined schema, so every part matches it
+    return conform_to_schema(df, COMBINED_SCHEMA)
+
+
+@metrics_util.stage("transform")
+def transform(
+    export_csv: bool = False,
+    time_frame: str = None,
+    manifests: list = None,
+    chunk_records: int = CHUNK_RECORDS,
+):
+    # manifests: extract manifest object names of the run. Without them the run's
+    # prefix is listed to find the records
+    source = "cargurus"
+    time_frame = time_frame or datetime.now().strftime("%Y-%m-%d/%H")
+    reference_year = datetime.now().year
+
+    failures = []
+    expected = None
+    if manifests is not None:
+        inputs = [minio_util.read_manifest(name) for name in manifests]
+        object_names = [obj["key"] for m in inputs for obj in m["objects"]]
+        records = minio_util.read_records(object_names, failures=failures)
+        expected = sum(m["records"] for m in inputs)
+    else:
+        records = minio_util.download_json(
+            source=source, time_frame=time_frame, failures=failures
+        )
+
+    # Records are streamed through in chunks, each one uploaded as its own Parquet part
+    # (and appended to the optional CSV export) before the next is read
+    parts = []
+    read = 0
+    csv_file = None
+    if export_csv:
+        csv_file = tempfile.NamedTemporaryFile(mode="w", suffix=".csv", newline="")
+    try:
+        for chunk in chunks(records, chunk_records):
+            read += len(chunk)
+            df = transform_chunk(chunk, reference_year)
+            del chunk
+            if df.empty:
+                continue
+            parts.append(
+                minio_util.upload_parquet(
+                    df=df,
+                    source=source,
+                    time_frame=time_frame,
+                    schema=COMBINED_SCHEMA,
+                    part=len(parts),
+                )
+            )
+            if csv_file is not None:
+                df.to_csv(csv_file, index=False, header=len(parts) == 1)
+
+        # An empty run still gets one (empty) part with the schema
+        if not parts:
+            df = conform_to_schema(pd.DataFrame(), COMBINED_SCHEMA)
+            parts.append(
+                minio_util.upload_parquet(
+                    df=df,
+                    source=source,
+                    time_frame=time_frame,
+                    schema=COMBINED_SCHEMA,
+                    part=0,
+                )
+            )
+            if csv_file is not None:
+                df.to_csv(csv_file, index=False)
+        if csv_file is not None:
+            csv_file.flush()
+            minio_util.upload_file(
+                object_name=f"{source}/{time_frame}/combined.csv",
+                file_path=csv_file.name,
+                content_type="text/csv",
+            )
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+    minio_util.remove_other_objects(
+        f"{source}/{time_frame}/combined", {part["key"] for part in parts}
     )
 
-    # Cast certain numeric columns to integer
-    integer_cols = [
-        "seller.reviewCount",
-        "history.daysAtDealer",
-        "history.daysOnCarGurus",
-        "history.accidentCount",
-        "history.ownerCount",
-        "priceInfo.savedCount",
-    ]
-    for col in integer_cols:
-        df[col] = df[col].astype("Int64")
+    if expected is not None and read != expected:
+        print(f"Read {read} records, the manifests list {expected}")
+    if failures:
+        print(f"Skipped {len(failures)} unreadable objects")
+    TRANSFORM_RECORDS.inc(read, result="read")
+    TRANSFORM_RECORDS.inc(len(failures), result="unreadable_object")
+    records_written = sum(part["records"] for part in parts)
+    print(f"Transformed {read} records into {len(parts)} parts, {records_written} kept")
 
-    # Upload final transformed data into MinIO as one combined CSV
-    minio_util.upload_csv(df=df, source=source, time_frame=time_frame)
+    # Load reads the output through this manifest, returned to Airflow as XCom
+    return minio_util.write_manifest(
+        f"{source}/{time_frame}/manifests/transform.json",
+        {
+            "run_id": time_frame,
+            "records": records_written,
+            "objects": parts,
+            "inputs": manifests or [],
+        },
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from bisect import bisect_left
+import threading
+import time
+import os
+
+
+load_dotenv()
+# Directory scraped by the node_exporter textfile collector, one file per stage run
+METRICS_TEXTFILE_DIR = os.getenv("METRICS_TEXTFILE_DIR")
+# Mirror metrics to OpenTelemetry (OTLP exporter configured via the standard OTEL_* env)
+METRICS_OTEL = os.getenv("METRICS_OTEL", "").lower() in ("1", "true", "yes")
+# Where profiles are written. Which stages to profile, PROFILE_STAGES (comma separated,
+# e.g. "extract,load"), is read each time a stage starts
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PREFIX = "used_cars_"
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+_lock = threading.Lock()
+_metrics = {}
+_stage_labels = {}
+_meter = None
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str):
+        self.name = PREFIX + name
+        self.help = help
+        self.values = {}
+        self.otel_instrument = None
+
+    def clear(self):
+        with _lock:
+            self.values = {}
+
+    def _key(self, labels: dict):
+        return tuple(sorted(labels.items()))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + value
+        if _meter is not None:
+            _otel_instrument(self).add(value, {**_stage_labels, **labels})
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self.values[self._key(labels)] = value
+        if _meter is not None:
+            _otel_instrument(self).set(value, {**_stage_labels, **labels})
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: list = None):
+        super().__init__(name, help)
+        self.buckets = buckets or LATENCY_BUCKETS
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts, _, _ = state = self.values[key]
+            counts[bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+        if _meter is not None:
+            _otel_instrument(self).record(value, {**_stage_labels, **labels})
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else repr(float(bound))
+                samples.append(
+                    (self.name + "_bucket", labels + (("le", le),), cumulative)
+                )
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, count))
+        return samples
+
+
+def _register(metric: Metric):
+    # Modules define their metrics at import, re-imports get the same object back
+    with _lock:
+        return _metrics.setdefault(metric.name, metric)
+
+
+def counter(name: str, help: str):
+    return _register(Counter(name, help))
+
+
+def gauge(name: str, help: str):
+    return _register(Gauge(name, help))
+
+
+def histogram(name: str, help: str, buckets: list = None):
+    return _register(Histogram(name, help, buckets))
+
+
+STAGE_WALL_SECONDS = gauge("stage_wall_seconds", "Wall clock time of the stage run")
+STAGE_CPU_SECONDS = gauge("stage_cpu_seconds", "CPU time of the stage run")
+STAGE_SUCCESS = gauge("stage_success", "1 if the stage run finished without error")
+STAGE_FINISHED = gauge("stage_finished_timestamp", "When the stage run finished")
+
+
+def _otel_instrument(metric: Metric):
+    if metric.otel_instrument is None:
+        if metric.kind == "counter":
+            metric.otel_instrument = _meter.create_counter(
+                metric.name, description=metric.help
+            )
+        elif metric.kind == "gauge":
+            metric.otel_instrument = _meter.create_gauge(
+                metric.name, description=metric.help
+            )
+        else:
+            metric.otel_instrument = _meter.create_histogram(
+                metric.name, unit="s", description=metric.help
+            )
+    return metric.otel_instrument
+
+
+def _start_otel():
+    global _meter
+    try:
+        from opentelemetry import metrics
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
+            OTLPMetricExporter,
+        )
+    except ImportError:
+        print(
+            "METRICS_OTEL is set but the OpenTelemetry SDK/OTLP exporter isn't installed"
+        )
+        return
+    if _meter is None:
+        reader = PeriodicExportingMetricReader(OTLPMetricExporter())
+        metrics.set_meter_provider(MeterProvider(metric_readers=[reader]))
+        _meter = metrics.get_meter("used_cars")
+
+
+def _flush_otel():
+    if _meter is not None:
+        from opentelemetry import metrics
+
+        metrics.get_meter_provider().force_flush()
+
+
+def _format_labels(labels: tuple):
+    if not labels:
+        return ""
+    escaped = [
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render():
+    # Prometheus text exposition format, stage labels added to every sample
+    stage_labels = tuple(sorted(_stage_labels.items()))
+    lines = []
+    with _lock:
+        for metric in _metrics.values():
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(stage_labels + labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(directory: str):
+    name = "_".join(["used_cars", *[str(value) for value in _stage_labels.values()]])
+    path = os.path.join(directory, f"{name}.prom")
+    os.makedirs(directory, exist_ok=True)
+    # Write then rename, the collector must never read a partial file
+    with open(f"{path}.tmp", "w") as file:
+        file.write(render())
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def profile_requested(stage: str):
+    stages = os.getenv("PROFILE_STAGES", "")
+    return stage in [name.strip() for name in stages.split(",")]
+
+
+@contextmanager
+def _profile(stage: str, enabled: bool):
+    if not enabled:
+        yield
+        return
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{stage}-{time.strftime('%Y%m%d-%H%M%S')}")
+    # Sampling profiler when available, cProfile otherwise
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+
+    if Profiler is not None:
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(f"{path}.html", "w") as file:
+                file.write(profiler.output_html())
+            print(f"Wrote profile {path}.html")
+    else:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{path}.prof")
+            print(f"Wrote profile {path}.prof")
+
+
+@contextmanager
+def stage(name: str, profile: bool = None, **labels):
+    # Scope of one stage run: resets the metrics, times the stage, and exports on exit.
+    # profile turns profiling on or off for this run, by default PROFILE_STAGES decides
+    for metric in _metrics.values():
+        metric.clear()
+    _stage_labels.clear()
+    _stage_labels.update({"stage": name, **labels})
+    if METRICS_OTEL:
+        _start_otel()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    success = 0
+    try:
+        with _profile(name, profile_requested(name) if profile is None else profile):
+            yield
+        success = 1
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        STAGE_WALL_SECONDS.set(wall)
+        STAGE_CPU_SECONDS.set(cpu)
+        STAGE_SUCCESS.set(success)
+        STAGE_FINISHED.set(time.time())
+        print(f"Stage {name}: {wall:.1f}s wall, {cpu:.1f}s CPU")
+        if METRICS_TEXTFILE_DIR:
+            write_textfile(METRICS_TEXTFILE_DIR)
+        _flush_otel()
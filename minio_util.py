@@ -1,106 +1,575 @@
 from minio import Minio, S3Error
 from dotenv import load_dotenv
-from io import BytesIO, StringIO
-from datetime import datetime
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import metrics_util
+import msgspec
 import asyncio
-import time
+import gzip
 import json
 import os
 
 
 BUCKET_NAME = "used-cars"
+UPLOAD_WORKERS = 10
+UPLOAD_QUEUE_SIZE = 100
+UPLOAD_ATTEMPTS = 3
+UPLOAD_BACKOFF = 1
+DOWNLOAD_WORKERS = 10
+SHARD_MAX_RECORDS = 500
+SHARD_MAX_BYTES = 8 * 1024 * 1024
 
 
 load_dotenv()
 MINIO_USER = os.getenv("MINIO_USER")
 MINIO_PWD = os.getenv("MINIO_PWD")
+MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "localhost:9000")
+
+
+OBJECT_BYTES = metrics_util.counter(
+    "object_store_bytes_total", "Bytes uploaded to and downloaded from MinIO"
+)
+OBJECT_SECONDS = metrics_util.histogram(
+    "object_store_request_seconds", "MinIO request latency by operation"
+)
+UPLOAD_RETRIES = metrics_util.counter(
+    "object_store_upload_retries_total", "Upload attempts that were retried"
+)
+UPLOAD_FAILURES = metrics_util.counter(
+    "object_store_upload_failures_total", "Uploads given up on after every attempt"
+)
 
 
 client = Minio(
-    endpoint="localhost:9000",
+    endpoint=MINIO_ENDPOINT,
     access_key=MINIO_USER,
     secret_key=MINIO_PWD,
     secure=False,
 )
 
-semaphore = asyncio.Semaphore(10)
+
+def put_bytes(object_name: str, data: bytes, content_type: str):
+    # A fresh stream per call, so a retry never re-sends an already consumed buffer
+    with OBJECT_SECONDS.time(operation="put"):
+        client.put_object(
+            bucket_name=BUCKET_NAME,
+            object_name=object_name,
+            data=BytesIO(data),
+            length=len(data),
+            content_type=content_type,
+        )
+    OBJECT_BYTES.inc(len(data), direction="upload")
+
+
+def upload_file(object_name: str, file_path: str, content_type: str):
+    with OBJECT_SECONDS.time(operation="put"):
+        client.fput_object(
+            bucket_name=BUCKET_NAME,
+            object_name=object_name,
+            file_path=file_path,
+            content_type=content_type,
+        )
+    OBJECT_BYTES.inc(os.path.getsize(file_path), direction="upload")
 
 
-async def upload_json(source: str, car_vin: str, car_data: dict):
-    async with semaphore:
-        # Parse the json file name
-        file_name = f'{source}/{datetime.now().strftime("%Y-%m-%d/%H")}/{car_vin}.json'
+class Uploader:
+    def __init__(
+        self,
+        workers: int = UPLOAD_WORKERS,
+        queue_size: int = UPLOAD_QUEUE_SIZE,
+        attempts: int = UPLOAD_ATTEMPTS,
+        backoff: float = UPLOAD_BACKOFF,
+    ):
+        self.worker_count = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="minio-upload"
+        )
+        # Bounded queue: submit() waits when uploads fall behind scraping
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = []
+        self.uploaded = 0
+        self.failed = []
 
-        # Convert data dict to stream bytes
-        data_bytes = BytesIO(json.dumps(car_data).encode("utf-8"))
+    async def __aenter__(self):
+        self.start()
+        return self
 
-        # Upload data to bucket
-        for attempt in range(1, 4):
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.drain()
+
+    def start(self):
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self._worker()) for _ in range(self.worker_count)
+            ]
+
+    async def submit(
+        self, object_name: str, data: bytes, content_type: str, on_uploaded=None
+    ):
+        # on_uploaded: coroutine function awaited once the object is confirmed uploaded
+        self.start()
+        await self.queue.put((object_name, data, content_type, on_uploaded))
+
+    async def flush(self):
+        # Wait until every submitted object has been uploaded or given up on
+        await self.queue.join()
+
+    async def drain(self):
+        await self.flush()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.executor.shutdown(wait=True)
+        print(f"Uploaded {self.uploaded} objects, {len(self.failed)} failed")
+
+    async def _worker(self):
+        while True:
+            object_name, data, content_type, on_uploaded = await self.queue.get()
             try:
-                client.put_object(
-                    bucket_name=BUCKET_NAME,
-                    object_name=file_name,
-                    data=data_bytes,
-                    length=len(data_bytes.getvalue()),
-                    content_type="application/json",
+                if await self._upload(object_name, data, content_type) and on_uploaded:
+                    await on_uploaded()
+            except Exception as e:
+                # Keep the worker alive, or flush() would wait on a queue nobody serves
+                print(f"^^^^^ Failed to confirm upload of {object_name}: {e} ^^^^^")
+                UPLOAD_FAILURES.inc()
+                self.failed.append(object_name)
+            finally:
+                self.queue.task_done()
+
+    async def _upload(self, object_name: str, data: bytes, content_type: str):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                await loop.run_in_executor(
+                    self.executor, put_bytes, object_name, data, content_type
                 )
                 if attempt != 1:
                     print(
-                        f"^^^^^ Successfully uploaded {file_name} after {attempt} attempts ^^^^^"
+                        f"^^^^^ Successfully uploaded {object_name} after {attempt} attempts ^^^^^"
                     )
-                break
-            except S3Error as e:
-                print(f"^^^^^ Failed to upload {file_name} on attempt {attempt} ^^^^^")
-                time.sleep(3)
+                self.uploaded += 1
+                return True
+            except Exception as e:
+                print(
+                    f"^^^^^ Failed to upload {object_name} on attempt {attempt}: {e} ^^^^^"
+                )
+                if attempt < self.attempts:
+                    UPLOAD_RETRIES.inc()
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+        UPLOAD_FAILURES.inc()
+        self.failed.append(object_name)
+        return False
 
 
-def download_json(source: str, time_frame: str):
-    prefix = f"{source}/{time_frame}"
+class ShardWriter:
+    def __init__(
+        self,
+        uploader: Uploader,
+        source: str,
+        time_frame: str,
+        writer_id: str = "main",
+        max_records: int = SHARD_MAX_RECORDS,
+        max_bytes: int = SHARD_MAX_BYTES,
+        checkpoint: "Checkpoint" = None,
+    ):
+        self.uploader = uploader
+        self.prefix = f"{source}/{time_frame}"
+        self.writer_id = writer_id
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.checkpoint = checkpoint
+        self.shard_count = 0
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_index = {}
+        self.buffer_listing_ids = []
+        # VIN -> shard object and byte range of its record within that shard, for
+        # shards confirmed uploaded
+        self.index = {}
+        # Resuming: keep the confirmed shards and never reuse a shard number
+        if checkpoint is not None:
+            self.index = dict(checkpoint.index)
+            self.shard_count = checkpoint.next_shard
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def add(self, car_vin: str, car_data, listing_id: str = None):
+        # Each record is its own gzip member: the shard is still one valid gzip stream,
+        # and a single record can be range-read and decompressed on its own
+        member = gzip.compress(msgspec.json.encode(car_data) + b"\n", compresslevel=6)
+        self.buffer_index[car_vin] = (self.buffer_bytes, len(member))
+        if listing_id is not None:
+            self.buffer_listing_ids.append(listing_id)
+        self.buffer.append(member)
+        self.buffer_bytes += len(member)
+
+        if len(self.buffer) >= self.max_records or self.buffer_bytes >= self.max_bytes:
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+
+        shard_name = (
+            f"{self.prefix}/shards/{self.writer_id}-{self.shard_count:05d}.ndjson.gz"
+        )
+        data = b"".join(self.buffer)
+        shard_index = {
+            car_vin: {"shard": shard_name, "offset": offset, "length": length}
+            for car_vin, (offset, length) in self.buffer_index.items()
+        }
+        if self.checkpoint is not None:
+            self.checkpoint.next_shard = self.shard_count + 1
+        on_uploaded = partial(
+            self.confirm,
+            {"key": shard_name, "size": len(data), "records": len(self.buffer)},
+            shard_index,
+            self.buffer_listing_ids,
+        )
+        self.shard_count += 1
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_index = {}
+        self.buffer_listing_ids = []
+
+        await self.uploader.submit(
+            object_name=shard_name,
+            data=data,
+            content_type="application/gzip",
+            on_uploaded=on_uploaded,
+        )
+
+    async def confirm(self, shard: dict, shard_index: dict, listing_ids: list):
+        self.index.update(shard_index)
+        if self.checkpoint is not None:
+            await self.checkpoint.confirm(shard, shard_index, listing_ids)
+
+    async def close(self):
+        # The index lists only shards whose upload went through
+        await self.flush()
+        await self.uploader.flush()
+        await self.uploader.submit(
+            object_name=f"{self.prefix}/index/{self.writer_id}.json",
+            data=json.dumps(self.index).encode("utf-8"),
+            content_type="application/json",
+        )
+
+
+class Checkpoint:
+    # Extraction progress of one writer within a run, kept in the bucket so a retried
+    # task resumes where the previous attempt stopped. Only confirmed uploads count
+    def __init__(self, source: str, time_frame: str, writer_id: str):
+        self.prefix = f"{source}/{time_frame}"
+        self.writer_id = writer_id
+        self.object_name = f"{self.prefix}/checkpoints/{writer_id}.json"
+        # Search pages whose listings are all persisted
+        self.pages = set()
+        # Listings persisted in confirmed shards, the shards (key, size, records) and
+        # their VIN index entries
+        self.listing_ids = set()
+        self.shards = []
+        self.index = {}
+        # Shard numbers below this may already have been used
+        self.next_shard = 0
+        self.complete = False
+        # Page -> listing ids, for pages not done yet
+        self.page_listings = {}
+        # Listing id -> reason, for listings no attempt will get (e.g. a 404). They
+        # don't keep their page open
+        self.failed = {}
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def load(cls, source: str, time_frame: str, writer_id: str):
+        checkpoint = cls(source, time_frame, writer_id)
+        try:
+            state = json.loads(get_bytes(checkpoint.object_name))
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                return checkpoint
+            raise
+        checkpoint.pages = set(state["pages"])
+        checkpoint.listing_ids = set(state["listing_ids"])
+        checkpoint.shards = state["shards"]
+        checkpoint.index = state["index"]
+        checkpoint.next_shard = state["next_shard"]
+        checkpoint.complete = state["complete"]
+        checkpoint.failed = state.get("failed", {})
+        return checkpoint
+
+    def discard_unconfirmed_shards(self):
+        # Shards the previous attempt uploaded without confirming would be read twice
+        confirmed = {shard["key"] for shard in self.shards}
+        for obj in client.list_objects(
+            BUCKET_NAME,
+            prefix=f"{self.prefix}/shards/{self.writer_id}-",
+            recursive=True,
+        ):
+            if obj.object_name not in confirmed:
+                client.remove_object(BUCKET_NAME, obj.object_name)
+                print(f"Removed unconfirmed shard {obj.object_name}")
+
+    def track_page(self, page: int, listing_ids: list):
+        self.page_listings[page] = set(listing_ids)
+
+    async def confirm(self, shard: dict, shard_index: dict, listing_ids: list):
+        self.shards.append(shard)
+        self.index.update(shard_index)
+        self.listing_ids.update(listing_ids)
+        await self.save()
+
+    async def save(self):
+        async with self.lock:
+            settled = self.listing_ids | self.failed.keys()
+            done = [
+                page
+                for page, listing_ids in self.page_listings.items()
+                if listing_ids <= settled
+            ]
+            for page in done:
+                self.pages.add(page)
+                del self.page_listings[page]
+
+            state = {
+                "pages": sorted(self.pages),
+                "listing_ids": sorted(self.listing_ids),
+                "shards": self.shards,
+                "index": self.index,
+                "next_shard": self.next_shard,
+                "complete": self.complete,
+                "failed": self.failed,
+            }
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    put_bytes,
+                    self.object_name,
+                    json.dumps(state).encode("utf-8"),
+                    "application/json",
+                )
+            except Exception as e:
+                # The next save carries this progress too
+                print(f"Failed to save checkpoint {self.object_name}: {e}")
+
+    def manifest(self):
+        # What this writer produced for the run: exactly the confirmed shards
+        return {
+            "run_id": self.prefix.split("/", 1)[1],
+            "writer_id": self.writer_id,
+            "complete": self.complete,
+            "records": sum(shard["records"] for shard in self.shards),
+            "objects": self.shards,
+            "index": f"{self.prefix}/index/{self.writer_id}.json",
+        }
 
-    cars = client.list_objects(bucket_name=BUCKET_NAME, prefix=prefix, recursive=True)
 
-    records = []
-    for car in cars:
+def write_manifest(object_name: str, manifest: dict):
+    put_bytes(object_name, json.dumps(manifest).encode("utf-8"), "application/json")
+    return object_name
+
+
+def read_manifest(object_name: str):
+    return json.loads(get_bytes(object_name))
+
+
+def get_bytes(object_name: str, offset: int = 0, length: int = 0):
+    with OBJECT_SECONDS.time(operation="get"):
         response = client.get_object(
-            bucket_name=BUCKET_NAME, object_name=car.object_name
+            bucket_name=BUCKET_NAME,
+            object_name=object_name,
+            offset=offset,
+            length=length,
         )
-        json_bytes = response.read()
-        response.close()
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+    OBJECT_BYTES.inc(len(data), direction="download")
+    return data
+
+
+def read_objects(
+    object_names, parse, workers: int = DOWNLOAD_WORKERS, failures: list = None
+):
+    # Fetch and parse objects on a thread pool, yielding results in completion order.
+    # Object names are consumed lazily, so a paginated LIST feeds GETs as it goes
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="minio-download"
+    ) as executor:
+        pending = {}
+
+        def collect(done):
+            for future in done:
+                object_name = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    print(f"Failed to read object {object_name}: {e}")
+                    if failures is not None:
+                        failures.append((object_name, e))
 
         try:
-            json_data = json.loads(json_bytes)
-            records.append(json_data)
-        except Exception as e:
-            print(f"Failed to parse object {car.object_name}: {e}")
-
-    return records
-
-
-def upload_csv(df: pd.DataFrame, source: str, time_frame: str):
-    # Convert dataframe to CSV bytes
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-    csv_bytes = BytesIO(csv_buffer.getvalue().encode("utf-8"))
-
-    # Write the CSV bytes to MinIO
-    client.put_object(
-        bucket_name=BUCKET_NAME,
-        object_name=f"{source}/{time_frame}/combined.csv",
-        data=csv_bytes,
-        length=len(csv_bytes.getvalue()),
-        content_type="text/csv",
+            for object_name in object_names:
+                future = executor.submit(
+                    lambda name: parse(get_bytes(name)), object_name
+                )
+                pending[future] = object_name
+                # Keep a bounded number of requests in flight
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from collect(done)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def parse_shard(data: bytes):
+    return [json.loads(line) for line in gzip.decompress(data).splitlines() if line]
+
+
+def is_record_object(prefix: str, object_name: str):
+    # Sharded runs keep records in shards/, older runs have one {vin}.json per car
+    relative_name = object_name[len(prefix) + 1 :]
+    if relative_name.startswith("shards/"):
+        return relative_name.endswith(".ndjson.gz")
+    return "/" not in relative_name and relative_name.endswith(".json")
+
+
+def parse_record_object(data: bytes):
+    if data[:2] == b"\x1f\x8b":
+        return parse_shard(data)
+    return [json.loads(data)]
+
+
+def download_json(
+    source: str, time_frame: str, workers: int = DOWNLOAD_WORKERS, failures: list = None
+):
+    prefix = f"{source}/{time_frame}"
+
+    objects = client.list_objects(
+        bucket_name=BUCKET_NAME, prefix=f"{prefix}/", recursive=True
+    )
+    object_names = (
+        obj.object_name for obj in objects if is_record_object(prefix, obj.object_name)
+    )
+    yield from read_records(object_names, workers, failures)
+
+
+def read_records(object_names, workers: int = DOWNLOAD_WORKERS, failures: list = None):
+    # Records of the given shard (or legacy per-VIN) objects, in completion order
+    for records in read_objects(object_names, parse_record_object, workers, failures):
+        yield from records
+
+
+def lookup_json(source: str, time_frame: str, car_vin: str):
+    prefix = f"{source}/{time_frame}"
+
+    # Find the shard holding the VIN through the run's index objects
+    for obj in client.list_objects(
+        bucket_name=BUCKET_NAME, prefix=f"{prefix}/index/", recursive=True
+    ):
+        index = json.loads(get_bytes(obj.object_name))
+        if car_vin in index:
+            entry = index[car_vin]
+            member = get_bytes(entry["shard"], entry["offset"], entry["length"])
+            return json.loads(gzip.decompress(member))
+
+    # Fall back to the one-object-per-VIN layout of older runs
+    try:
+        return json.loads(get_bytes(f"{prefix}/{car_vin}.json"))
+    except S3Error as e:
+        if e.code == "NoSuchKey":
+            return None
+        raise
+
+
+def upload_parquet(
+    df: pd.DataFrame, source: str, time_frame: str, schema: pa.Schema, part: int = None
+):
+    # Returns the uploaded object's manifest entry. Chunked transforms upload numbered
+    # parts under combined/, all with the same schema
+    if part is None:
+        object_name = f"{source}/{time_frame}/combined.parquet"
+    else:
+        object_name = f"{source}/{time_frame}/combined/part-{part:05d}.parquet"
+
+    # Convert dataframe to an in-memory Parquet buffer with the given schema
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, compression="zstd")
+    parquet_buffer = sink.getvalue()
+
+    # Write the Parquet buffer to MinIO without copying it into another stream
+    with OBJECT_SECONDS.time(operation="put"):
+        client.put_object(
+            bucket_name=BUCKET_NAME,
+            object_name=object_name,
+            data=pa.BufferReader(parquet_buffer),
+            length=parquet_buffer.size,
+            content_type="application/vnd.apache.parquet",
+        )
+    OBJECT_BYTES.inc(parquet_buffer.size, direction="upload")
+    return {"key": object_name, "size": parquet_buffer.size, "records": table.num_rows}
+
+
+def remove_other_objects(prefix: str, keep: set):
+    # Drop what an earlier attempt left under the prefix, e.g. extra parts of a run
+    # transformed again into fewer chunks
+    for obj in client.list_objects(
+        bucket_name=BUCKET_NAME, prefix=f"{prefix}/", recursive=True
+    ):
+        if obj.object_name not in keep:
+            client.remove_object(BUCKET_NAME, obj.object_name)
+
+
+def download_parquet(source: str, time_frame: str):
+    # The run's Parquet parts, or the single combined file of older runs
+    prefix = f"{source}/{time_frame}"
+    parts = sorted(
+        obj.object_name
+        for obj in client.list_objects(
+            bucket_name=BUCKET_NAME, prefix=f"{prefix}/combined/", recursive=True
+        )
+        if obj.object_name.endswith(".parquet")
+    )
+    if not parts:
+        return read_parquet(f"{prefix}/combined.parquet")
+    return pd.concat([read_parquet(part) for part in parts], ignore_index=True)
+
+
+def read_parquet(object_name: str):
+    # Read the Parquet file from MinIO
+    parquet_bytes = get_bytes(object_name)
+    table = pq.read_table(pa.BufferReader(parquet_bytes))
+
+    # Return the combined data as a DataFrame with nullable integer and boolean columns
+    return table.to_pandas(
+        types_mapper={
+            pa.int64(): pd.Int64Dtype(),
+            pa.bool_(): pd.BooleanDtype(),
+        }.get
     )
 
 
 def download_csv(source: str, time_frame: str):
     # Read the CSV file from MinIO
-    response = client.get_object(
-        bucket_name=BUCKET_NAME,
-        object_name=f"{source}/{time_frame}/combined.csv",
-    )
-    csv_bytes = response.read()
-    response.close()
+    csv_bytes = get_bytes(f"{source}/{time_frame}/combined.csv")
 
     # Return the comnbined CSV data as a DataFrame
-    return pd.read_csv(StringIO(csv_bytes.decode("utf-8")))
+    return pd.read_csv(BytesIO(csv_bytes))